@@ -0,0 +1,209 @@
+import sys
+import math
+import time
+import signal
+import struct
+import logging
+import multiprocessing
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Optional
+import watering_gpio
+import watering_logic
+import watering_sensors
+try:
+    import board
+    import busio
+    from adafruit_ads1x15 import ADS1115, AnalogIn, ads1x15
+except ImportError:
+    board = None
+    busio = None
+    ADS1115 = None
+    AnalogIn = None
+    ads1x15 = None
+
+# Level sensor acquisition in a supervised child process. A stuck I2C
+# transfer or a crashing driver only takes down the child; the controller
+# keeps switching valves and restarts the child once its heartbeat stops.
+#
+# The child publishes its latest readings into a fixed-layout shared memory
+# block guarded by a sequence counter (seqlock): the counter is odd while a
+# write is in progress, so a reader that sees the same even value before and
+# after copying the block has a consistent snapshot. Reads take no locks.
+
+MAX_VOLTAGES = 8
+MAX_CHANNELS = 4  # ADS1115 inputs
+
+SEQUENCE = struct.Struct('<Q')
+# heartbeat (monotonic), measured at (epoch), distance cm (NaN = none),
+# voltage count, tank voltages, ADC channel values (NaN = none)
+READINGS = struct.Struct(f'<ddd B{MAX_VOLTAGES}d {MAX_CHANNELS}d')
+READINGS_SIZE = SEQUENCE.size + READINGS.size
+READ_ATTEMPTS = 100
+
+@dataclass(slots=True)
+class Readings:
+    heartbeat: float
+    measured_at: float
+    distance: Optional[float]
+    voltages: list  # tank voltages, oldest first
+    values: list    # calibrated ADC channel values in config order, None before the first sample
+
+def publish(buf, seq, distance, voltages, values):
+    '''Write one set of readings, returns the new sequence number.'''
+    voltages = voltages[-MAX_VOLTAGES:]
+    values = [math.nan if value is None else value for value in values[:MAX_CHANNELS]]
+    SEQUENCE.pack_into(buf, 0, seq + 1)
+    READINGS.pack_into(buf, SEQUENCE.size,
+                       time.monotonic(), time.time(),
+                       math.nan if distance is None else distance,
+                       len(voltages), *voltages, *[0] * (MAX_VOLTAGES - len(voltages)),
+                       *values, *[math.nan] * (MAX_CHANNELS - len(values)))
+    SEQUENCE.pack_into(buf, 0, seq + 2)
+    return seq + 2
+
+def blinka_voltages(channel, max_attempts=20):
+    '''Up to 5 valid voltages of the Blinka ADS1115 channel.'''
+    voltage_stat = []
+    for attempt in range(max_attempts):
+        try:
+            voltage = channel.voltage
+        except Exception as e:
+            logging.error(f"Failed to read level sensor voltage: {e}")
+            continue
+        if watering_logic.is_valid_voltage(voltage):
+            voltage_stat.append(voltage)
+        if len(voltage_stat) >= 5:
+            break
+    return voltage_stat
+
+def acquire(buf, adc, ultrasonic, gpio_backend, interval):
+    '''Child process: read the level sensors every interval seconds until killed.'''
+    # The parent's handlers clean up MQTT and GPIO, which the child does not own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A second TimedRotatingFileHandler on the parent's log would roll it over
+    # at midnight too, log to stderr instead
+    root = logging.getLogger()
+    formatter = None
+    for handler in root.handlers[:]:
+        formatter = formatter or handler.formatter
+        root.removeHandler(handler)
+        handler.close()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+    root.addHandler(stream)
+    sonar = None
+    scanner = None
+    level_channel = None
+    if ultrasonic is not None:
+        sonar = watering_sensors.UltrasonicSensor(ultrasonic)
+        sonar.start()
+    if adc is not None:
+        gpio = watering_gpio.create_backend(gpio_backend) if adc.alert_pin is not None else None
+        scanner = watering_sensors.ADS1115Scanner(adc, gpio)
+        scanner.start(background=False)
+    elif ultrasonic is None and busio is not None and ADS1115 is not None:
+        level_channel = AnalogIn(ADS1115(busio.I2C(board.SCL, board.SDA)), ads1x15.Pin.A0)
+    seq = 0
+    while True:
+        started = time.monotonic()
+        distance = sonar.measure() if sonar is not None else None
+        voltages = []
+        values = []
+        if scanner is not None:
+            scanner.scan()
+            if 'tank' in scanner.channels:
+                voltages = scanner.voltages('tank')
+            values = [scanner.value(name) for name in scanner.channels]
+        elif level_channel is not None:
+            voltages = blinka_voltages(level_channel)
+        seq = publish(buf, seq, distance, voltages, values)
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+class SensorProcess:
+    '''
+    Supervises the acquisition child. read() returns the latest readings in
+    constant time; check() restarts the child when it died or its heartbeat
+    is older than timeout seconds.
+    '''
+
+    def __init__(self, adc, ultrasonic, gpio_backend, interval, timeout):
+        self.adc = adc
+        self.ultrasonic = ultrasonic
+        self.gpio_backend = gpio_backend
+        self.interval = interval
+        self.timeout = timeout
+        self.shm = None
+        self.process = None
+        self.started = 0
+
+    def start(self):
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=READINGS_SIZE)
+            self.shm.buf[:READINGS_SIZE] = bytes(READINGS_SIZE)
+        self.started = time.monotonic()
+        # fork: the child inherits the config and the shared memory mapping
+        self.process = multiprocessing.get_context('fork').Process(
+            target=acquire,
+            args=(self.shm.buf, self.adc, self.ultrasonic, self.gpio_backend, self.interval),
+            name='watering_sensors',
+            daemon=True,
+        )
+        self.process.start()
+        logging.info(f'Sensor process started with pid {self.process.pid}')
+
+    def read(self):
+        '''Latest readings, None if there are none yet. Never blocks.'''
+        buf = self.shm.buf
+        for attempt in range(READ_ATTEMPTS):
+            seq, = SEQUENCE.unpack_from(buf, 0)
+            if seq & 1:
+                continue
+            data = bytes(buf[SEQUENCE.size:READINGS_SIZE])
+            if SEQUENCE.unpack_from(buf, 0)[0] == seq:
+                break
+        else:
+            return None
+        if seq == 0:
+            return None
+        fields = READINGS.unpack(data)
+        heartbeat, measured_at, distance, count = fields[:4]
+        values = fields[4 + MAX_VOLTAGES:]
+        return Readings(heartbeat=heartbeat,
+                        measured_at=measured_at,
+                        distance=None if math.isnan(distance) else distance,
+                        voltages=list(fields[4:4 + count]),
+                        values=[None if math.isnan(value) else value for value in values])
+
+    def fresh(self):
+        '''Latest readings if they were taken within timeout seconds, otherwise None.'''
+        readings = self.read()
+        if readings is None or time.monotonic() - readings.heartbeat > self.timeout:
+            return None
+        return readings
+
+    def check(self):
+        '''Restart the child if it exited or stopped beating. Returns False on a restart.'''
+        readings = self.read()
+        last_beat = max(readings.heartbeat if readings is not None else 0, self.started)
+        age = time.monotonic() - last_beat
+        if self.process.is_alive():
+            if age <= self.timeout:
+                return True
+            logging.error(f'Sensor process heartbeat stopped {round(age)}s ago, restarting it')
+            self.process.kill()
+            self.process.join(1)
+        else:
+            logging.error(f'Sensor process exited with code {self.process.exitcode}, restarting it')
+        self.start()
+        return False
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(2)
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
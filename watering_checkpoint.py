@@ -0,0 +1,122 @@
+import os
+import time
+import struct
+import logging
+import threading
+from dataclasses import dataclass, field
+from watering_config import MAX_ZONE_NAME_SIZE
+
+# Controller state saved on every loop so a restart (Restart=always) picks up
+# where the previous process stopped. The file is a single fixed-size binary
+# record, written to a temporary file and renamed over the old one.
+
+CHECKPOINT_MAGIC = b'WTRC'
+CHECKPOINT_VERSION = 1
+MAX_BLOCKED_ZONES = 16
+ZONE_NAME_SIZE = MAX_ZONE_NAME_SIZE  # longer zone names are rejected by the config
+VOLUME_HISTORY_SIZE = 3
+
+# magic, version, written_at, refill_timer, water_volume, water_flowtimer,
+# cached_water_amount, cached_water_flow, history length, volume history,
+# ON outputs as a BCM pin bitmask, blocked zone count
+HEADER = struct.Struct(f'<4sHdddddd B{VOLUME_HISTORY_SIZE}d I B')
+# zone name, blocked since
+BLOCKED_ZONE = struct.Struct(f'<{ZONE_NAME_SIZE}sd')
+CHECKPOINT_SIZE = HEADER.size + MAX_BLOCKED_ZONES * BLOCKED_ZONE.size
+
+@dataclass(slots=True)
+class ControllerState:
+    written_at: float = 0
+    refill_timer: float = 0
+    water_volume: float = 0
+    water_flowtimer: float = 0
+    cached_water_amount: float = 0
+    cached_water_flow: float = 0
+    volume_history: list = field(default_factory=list)
+    outputs: set = field(default_factory=set)         # pins that are ON
+    blocked_zones: dict = field(default_factory=dict)  # zone name -> blocked since
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = bytearray(CHECKPOINT_SIZE)
+        self.lock = threading.Lock()
+
+    def save(self, state):
+        with self.lock:
+            history = state.volume_history[-VOLUME_HISTORY_SIZE:]
+            blocked = list(state.blocked_zones.items())[:MAX_BLOCKED_ZONES]
+            outputs = 0
+            for pin in state.outputs:
+                outputs |= 1 << pin
+            HEADER.pack_into(self.buffer, 0,
+                             CHECKPOINT_MAGIC, CHECKPOINT_VERSION, time.time(),
+                             state.refill_timer, state.water_volume, state.water_flowtimer,
+                             state.cached_water_amount, state.cached_water_flow,
+                             len(history), *history, *[0] * (VOLUME_HISTORY_SIZE - len(history)),
+                             outputs, len(blocked))
+            offset = HEADER.size
+            for i in range(MAX_BLOCKED_ZONES):
+                name, since = blocked[i] if i < len(blocked) else ('', 0)
+                BLOCKED_ZONE.pack_into(self.buffer, offset, name.encode()[:ZONE_NAME_SIZE], since)
+                offset += BLOCKED_ZONE.size
+            tmp_path = f'{self.path}.tmp'
+            try:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    os.write(fd, self.buffer)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logging.error(f'Failed to write checkpoint {self.path}: {e}')
+
+    def load(self, max_age):
+        '''The saved state, or None if there is none or it is older than max_age seconds.'''
+        try:
+            with open(self.path, 'rb') as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.error(f'Failed to read checkpoint {self.path}: {e}')
+            return None
+        if len(data) != CHECKPOINT_SIZE:
+            logging.warning(f'Ignoring checkpoint {self.path} of unexpected size {len(data)}')
+            return None
+        try:
+            return self.unpack(data, max_age)
+        except (struct.error, UnicodeDecodeError) as e:
+            logging.warning(f'Ignoring damaged checkpoint {self.path}: {e}')
+            return None
+
+    def unpack(self, data, max_age):
+        fields = HEADER.unpack_from(data, 0)
+        magic, version, written_at = fields[:3]
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            logging.warning(f'Ignoring checkpoint {self.path} with unknown format')
+            return None
+        age = time.time() - written_at
+        if not 0 <= age <= max_age:
+            logging.info(f'Ignoring checkpoint {self.path}, it is {round(age)}s old')
+            return None
+        refill_timer, water_volume, water_flowtimer, cached_water_amount, cached_water_flow = fields[3:8]
+        history_len = fields[8]
+        history = list(fields[9:9 + history_len])
+        outputs, blocked_count = fields[9 + VOLUME_HISTORY_SIZE:]
+        blocked_zones = {}
+        offset = HEADER.size
+        for i in range(min(blocked_count, MAX_BLOCKED_ZONES)):
+            name, since = BLOCKED_ZONE.unpack_from(data, offset)
+            blocked_zones[name.rstrip(b'\0').decode()] = since
+            offset += BLOCKED_ZONE.size
+        return ControllerState(written_at=written_at,
+                               refill_timer=refill_timer,
+                               water_volume=water_volume,
+                               water_flowtimer=water_flowtimer,
+                               cached_water_amount=cached_water_amount,
+                               cached_water_flow=cached_water_flow,
+                               volume_history=history,
+                               outputs={pin for pin in range(32) if outputs & (1 << pin)},
+                               blocked_zones=blocked_zones)
@@ -0,0 +1,466 @@
+import os
+import hashlib
+import pickle
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import Optional
+import yaml
+
+# Bump when the compiled classes change so stale caches are ignored
+CACHE_VERSION = 13
+
+DAYS = {'Mon': 0, 'Tue': 1, 'Wed': 2, 'Thu': 3, 'Fri': 4, 'Sat': 5, 'Sun': 6}
+TANK_REFILL_MODES = ('level', 'bobber', 'ultrasonic')
+GPIO_BACKENDS = ('auto', 'lgpio', 'rpi', 'sim')
+MAX_BCM_PIN = 27
+MAX_ZONE_NAME_SIZE = 32  # UTF-8 bytes, the size of a zone name in the checkpoint
+ADC_GAINS = (2/3, 1, 2, 4, 8, 16)
+ADC_DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
+UNKNOWN_STATES = ('unknown', 'unavailable')
+
+class ConfigError(ValueError):
+    pass
+
+def since_midnight(now: datetime) -> float:
+    return now.hour*3600 + now.minute*60 + now.second + now.microsecond/1e6
+
+@dataclass(frozen=True, slots=True)
+class Period:
+    day: str
+    weekday: int
+    time: str
+    start: int        # seconds since midnight
+    end: int          # seconds since midnight, may be past 24h
+    duration: int     # minutes
+
+    def is_active(self, now: datetime) -> bool:
+        '''
+        The period is active from its start until start + duration inclusive.
+        It never wraps past midnight into the next day.
+        '''
+        if now.weekday() != self.weekday:
+            return False
+        return self.start <= since_midnight(now) <= self.end
+
+@dataclass(frozen=True, slots=True)
+class Zone:
+    name: str
+    channel: int
+    schedule: tuple = ()
+
+    def needs_watering(self, now: datetime) -> bool:
+        if not self.schedule:
+            return False
+        # Same check as Period.is_active(), done once for all periods
+        weekday = now.weekday()
+        elapsed = since_midnight(now)
+        for period in self.schedule:
+            if period.weekday == weekday and period.start <= elapsed <= period.end:
+                return True
+        return False
+
+@dataclass(frozen=True, slots=True)
+class General:
+    device_name: str
+    main_power_channel: int
+    sleep_time: float
+    blocking_timeout: float
+    config_reload_timeout: float
+    water_input_channel: Optional[int] = None
+    tank_refill_mode: str = 'level'
+    refill_timeout: Optional[float] = None
+    refill_amount: Optional[float] = None
+    refill_full_amount: Optional[float] = None  # ultrasonic mode stops the refill here
+    mqtt_outbox: str = 'mqtt_outbox.spool'
+    mqtt_drain_rate: float = 10
+    loop_deadline: float = 120  # seconds on top of sleep_time
+    gpio_backend: str = 'auto'
+    checkpoint: str = 'watering_control.state'
+    checkpoint_max_age: float = 300  # seconds, older checkpoints are ignored
+    valve_overlap: float = 0  # seconds both valves stay open at a zone handover
+    sensor_process: bool = False  # read the level sensors in a supervised child process
+    sensor_interval: float = 5    # seconds between readings of the child
+    sensor_timeout: float = 60    # seconds without a heartbeat before the child is restarted
+    status_port: Optional[int] = None    # local status API on 127.0.0.1
+    status_socket: Optional[str] = None  # or on a Unix socket
+    ha_url: str = 'https://ha.jktu.org.ua'
+    ha_statestream: str = 'homeassistant/statestream'  # base_topic of HA's mqtt_statestream
+
+@dataclass(frozen=True, slots=True)
+class AdcChannel:
+    name: str
+    input: int              # ADS1115 single-ended input AIN0..AIN3
+    gain: float = 1
+    data_rate: int = 128    # samples per second
+    zero_voltage: float = 0
+    full_voltage: float = 2.505
+    full_value: float = 1000
+    unit: str = 'L'
+    buffer_size: int = 8
+
+    def value(self, voltage):
+        '''Convert a voltage to the calibrated value.'''
+        return (voltage - self.zero_voltage) / (self.full_voltage - self.zero_voltage) * self.full_value
+
+@dataclass(frozen=True, slots=True)
+class Adc:
+    bus: int = 1
+    address: int = 0x48
+    alert_pin: Optional[int] = None  # ALERT/RDY, conversion ready interrupt
+    scan_interval: float = 1         # seconds between scans of all channels
+    channels: tuple = ()
+
+@dataclass(frozen=True, slots=True)
+class Ultrasonic:
+    trigger_pin: int
+    echo_pin: int
+    geometry: tuple             # ((distance cm, liters), ...) sorted by distance
+    samples: int = 5            # pings per measurement
+    ping_interval: float = 0.06  # seconds, lets echoes of the previous ping die out
+    timeout: float = 0.05       # seconds to wait for an echo
+    min_distance: float = 20    # cm, blind zone of the AJ-SR04M
+    max_distance: float = 600   # cm
+    tolerance: float = 5        # cm from the median before a ping is an outlier
+
+@dataclass(frozen=True, slots=True)
+class Input:
+    name: str
+    entity: str                  # Home Assistant entity id
+    topic: str                   # MQTT topic the entity state is pushed to
+    skip_states: tuple = ()      # states that stop watering
+    skip_above: Optional[float] = None
+    skip_below: Optional[float] = None
+    skip_unknown: bool = False   # stop watering while the state is not known
+
+    def skips_watering(self, state) -> bool:
+        '''state - the entity state string, None if nothing was received yet'''
+        if state is None or state in UNKNOWN_STATES:
+            return self.skip_unknown
+        if state in self.skip_states:
+            return True
+        if self.skip_above is None and self.skip_below is None:
+            return False
+        try:
+            value = float(state)
+        except ValueError:
+            return self.skip_unknown
+        if self.skip_above is not None and value > self.skip_above:
+            return True
+        if self.skip_below is not None and value < self.skip_below:
+            return True
+        return False
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    general: General
+    zones: tuple
+    # Resolved pin maps
+    zones_by_name: dict = field(default_factory=dict)
+    zones_by_channel: dict = field(default_factory=dict)
+    chan_list: tuple = ()
+    adc: Optional[Adc] = None
+    ultrasonic: Optional[Ultrasonic] = None
+    inputs: tuple = ()
+
+def _require(section, key, kind, where):
+    if key not in section or section[key] is None:
+        raise ConfigError(f'{where}.{key} is required')
+    return _check(section[key], kind, f'{where}.{key}')
+
+def _optional(section, key, kind, where, default=None):
+    if section.get(key) is None:
+        return default
+    return _check(section[key], kind, f'{where}.{key}')
+
+def _check(value, kind, where):
+    if kind is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ConfigError(f'{where} must be a positive number, got {value!r}')
+        return value
+    if kind is int:
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= MAX_BCM_PIN:
+            raise ConfigError(f'{where} must be a BCM pin number (0-{MAX_BCM_PIN}), got {value!r}')
+        return value
+    if not isinstance(value, kind) or value == '':
+        raise ConfigError(f'{where} must be a non-empty {kind.__name__}, got {value!r}')
+    return value
+
+def compile_period(period, where):
+    if not isinstance(period, dict):
+        raise ConfigError(f'{where} must be a mapping')
+    day = _require(period, 'day', str, where)
+    if day not in DAYS:
+        raise ConfigError(f'{where}.day must be one of {", ".join(DAYS)}, got {day!r}')
+    time_str = _require(period, 'time', str, where)
+    try:
+        start = datetime.strptime(time_str, '%H:%M')
+    except ValueError:
+        raise ConfigError(f'{where}.time must be HH:MM, got {time_str!r}')
+    duration = _require(period, 'duration', float, where)
+    return Period(day=day,
+                  weekday=DAYS[day],
+                  time=time_str,
+                  start=start.hour*3600 + start.minute*60,
+                  end=start.hour*3600 + start.minute*60 + duration*60,
+                  duration=duration)
+
+def compile_adc(section) -> Adc:
+    if not isinstance(section, dict):
+        raise ConfigError('adc must be a mapping')
+    if not isinstance(section.get('channels'), list) or not section['channels']:
+        raise ConfigError('adc.channels must be a non-empty list')
+    channels = []
+    for i, channel in enumerate(section['channels']):
+        where = f'adc.channels[{i}]'
+        if not isinstance(channel, dict):
+            raise ConfigError(f'{where} must be a mapping')
+        adc_input = channel.get('input')
+        if adc_input not in (0, 1, 2, 3):
+            raise ConfigError(f'{where}.input must be 0-3, got {adc_input!r}')
+        if channel.get('gain') == '2/3':
+            channel = dict(channel, gain=2/3)
+        gain = _optional(channel, 'gain', float, where, 1)
+        gain = next((g for g in ADC_GAINS if abs(g - gain) < 0.01), None)
+        if gain is None:
+            raise ConfigError(f'{where}.gain must be one of 2/3, 1, 2, 4, 8, 16')
+        data_rate = channel.get('data_rate', 128)
+        if data_rate not in ADC_DATA_RATES:
+            raise ConfigError(f'{where}.data_rate must be one of {ADC_DATA_RATES}')
+        zero_voltage = channel.get('zero_voltage', 0)
+        if isinstance(zero_voltage, bool) or not isinstance(zero_voltage, (int, float)):
+            raise ConfigError(f'{where}.zero_voltage must be a number')
+        full_voltage = _optional(channel, 'full_voltage', float, where, 2.505)
+        if full_voltage <= zero_voltage:
+            raise ConfigError(f'{where}.full_voltage must be above zero_voltage')
+        buffer_size = _optional(channel, 'buffer_size', float, where, 8)
+        if not isinstance(buffer_size, int):
+            raise ConfigError(f'{where}.buffer_size must be an integer')
+        channels.append(AdcChannel(
+            name=_require(channel, 'name', str, where),
+            input=adc_input,
+            gain=gain,
+            data_rate=data_rate,
+            zero_voltage=zero_voltage,
+            full_voltage=full_voltage,
+            full_value=_optional(channel, 'full_value', float, where, 1000),
+            unit=_optional(channel, 'unit', str, where, 'L'),
+            buffer_size=buffer_size,
+        ))
+    names = [channel.name for channel in channels]
+    inputs = [channel.input for channel in channels]
+    if len(set(names)) != len(names) or len(set(inputs)) != len(inputs):
+        raise ConfigError('adc channel names and inputs must be unique')
+    address = section.get('address', 0x48)
+    if address not in (0x48, 0x49, 0x4a, 0x4b):
+        raise ConfigError(f'adc.address must be 0x48-0x4b, got {address!r}')
+    bus = section.get('bus', 1)
+    if isinstance(bus, bool) or not isinstance(bus, int) or bus < 0:
+        raise ConfigError(f'adc.bus must be an I2C bus number, got {bus!r}')
+    return Adc(bus=bus,
+               address=address,
+               alert_pin=_optional(section, 'alert_pin', int, 'adc'),
+               scan_interval=_optional(section, 'scan_interval', float, 'adc', 1),
+               channels=tuple(channels))
+
+def compile_ultrasonic(section) -> Ultrasonic:
+    if not isinstance(section, dict):
+        raise ConfigError('ultrasonic must be a mapping')
+    geometry = section.get('geometry')
+    if not isinstance(geometry, list) or len(geometry) < 2:
+        raise ConfigError('ultrasonic.geometry must list at least two [distance, liters] rows')
+    rows = []
+    for i, row in enumerate(geometry):
+        if not isinstance(row, list) or len(row) != 2 or \
+                not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in row):
+            raise ConfigError(f'ultrasonic.geometry[{i}] must be [distance, liters], got {row!r}')
+        rows.append((row[0], row[1]))
+    rows.sort()
+    if len({row[0] for row in rows}) != len(rows):
+        raise ConfigError('ultrasonic.geometry distances must be unique')
+    samples = _optional(section, 'samples', float, 'ultrasonic', 5)
+    if not isinstance(samples, int):
+        raise ConfigError('ultrasonic.samples must be an integer')
+    return Ultrasonic(trigger_pin=_require(section, 'trigger_pin', int, 'ultrasonic'),
+                      echo_pin=_require(section, 'echo_pin', int, 'ultrasonic'),
+                      geometry=tuple(rows),
+                      samples=samples,
+                      ping_interval=_optional(section, 'ping_interval', float, 'ultrasonic', 0.06),
+                      timeout=_optional(section, 'timeout', float, 'ultrasonic', 0.05),
+                      min_distance=_optional(section, 'min_distance', float, 'ultrasonic', 20),
+                      max_distance=_optional(section, 'max_distance', float, 'ultrasonic', 600),
+                      tolerance=_optional(section, 'tolerance', float, 'ultrasonic', 5))
+
+def _number(section, key, where):
+    value = section.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ConfigError(f'{where}.{key} must be a number, got {value!r}')
+    return value
+
+def compile_inputs(section, general) -> tuple:
+    if not isinstance(section, dict):
+        raise ConfigError('inputs must be a mapping')
+    inputs = []
+    for name, item in section.items():
+        where = f'inputs.{name}'
+        if not isinstance(item, dict):
+            raise ConfigError(f'{where} must be a mapping')
+        entity = _require(item, 'entity', str, where)
+        domain, _, object_id = entity.partition('.')
+        if not domain or not object_id:
+            raise ConfigError(f'{where}.entity must be <domain>.<object_id>, got {entity!r}')
+        skip_states = item.get('skip_watering_states') or []
+        if not isinstance(skip_states, list):
+            raise ConfigError(f'{where}.skip_watering_states must be a list')
+        skip_unknown = item.get('skip_when_unknown', False)
+        if not isinstance(skip_unknown, bool):
+            raise ConfigError(f'{where}.skip_when_unknown must be true or false')
+        inputs.append(Input(
+            name=str(name),
+            entity=entity,
+            topic=_optional(item, 'topic', str, where, f'{general.ha_statestream}/{domain}/{object_id}/state'),
+            skip_states=tuple(str(state) for state in skip_states),
+            skip_above=_number(item, 'skip_watering_above', where),
+            skip_below=_number(item, 'skip_watering_below', where),
+            skip_unknown=skip_unknown,
+        ))
+    return tuple(inputs)
+
+def compile_config(raw) -> Config:
+    '''Validate the parsed YAML and turn it into immutable Config objects.'''
+    if not isinstance(raw, dict) or not isinstance(raw.get('general'), dict):
+        raise ConfigError('general section is required')
+    section = raw['general']
+    general = General(
+        device_name=_require(section, 'device_name', str, 'general'),
+        main_power_channel=_require(section, 'main_power_channel', int, 'general'),
+        sleep_time=_require(section, 'sleep_time', float, 'general'),
+        blocking_timeout=_require(section, 'blocking_timeout', float, 'general'),
+        config_reload_timeout=_require(section, 'config_reload_timeout', float, 'general'),
+        water_input_channel=_optional(section, 'water_input_channel', int, 'general'),
+        tank_refill_mode=_optional(section, 'tank_refill_mode', str, 'general', 'level'),
+        refill_timeout=_optional(section, 'refill_timeout', float, 'general'),
+        refill_amount=_optional(section, 'refill_amount', float, 'general'),
+        refill_full_amount=_optional(section, 'refill_full_amount', float, 'general'),
+        mqtt_outbox=_optional(section, 'mqtt_outbox', str, 'general', 'mqtt_outbox.spool'),
+        mqtt_drain_rate=_optional(section, 'mqtt_drain_rate', float, 'general', 10),
+        loop_deadline=_optional(section, 'loop_deadline', float, 'general', 120),
+        gpio_backend=_optional(section, 'gpio_backend', str, 'general', 'auto'),
+        checkpoint=_optional(section, 'checkpoint', str, 'general', 'watering_control.state'),
+        checkpoint_max_age=_optional(section, 'checkpoint_max_age', float, 'general', 300),
+        valve_overlap=_number(section, 'valve_overlap', 'general') or 0,
+        sensor_process=section.get('sensor_process', False),
+        sensor_interval=_optional(section, 'sensor_interval', float, 'general', 5),
+        sensor_timeout=_optional(section, 'sensor_timeout', float, 'general', 60),
+        status_port=section.get('status_port'),
+        status_socket=_optional(section, 'status_socket', str, 'general'),
+        ha_url=_optional(section, 'ha_url', str, 'general', 'https://ha.jktu.org.ua').rstrip('/'),
+        ha_statestream=_optional(section, 'ha_statestream', str, 'general', 'homeassistant/statestream').rstrip('/'),
+    )
+    if general.tank_refill_mode not in TANK_REFILL_MODES:
+        raise ConfigError(f'general.tank_refill_mode must be one of {", ".join(TANK_REFILL_MODES)}')
+    if not 0 <= general.valve_overlap < general.loop_deadline:
+        raise ConfigError('general.valve_overlap must be between 0 and loop_deadline seconds')
+    if not isinstance(general.sensor_process, bool):
+        raise ConfigError('general.sensor_process must be true or false')
+    if general.sensor_timeout <= general.sensor_interval:
+        raise ConfigError('general.sensor_timeout must be longer than sensor_interval')
+    if general.status_port is not None and (isinstance(general.status_port, bool) or
+                                            not isinstance(general.status_port, int) or
+                                            not 0 < general.status_port < 65536):
+        raise ConfigError(f'general.status_port must be a TCP port number, got {general.status_port!r}')
+    if general.status_port is not None and general.status_socket is not None:
+        raise ConfigError('general.status_port and status_socket are mutually exclusive')
+    if general.gpio_backend not in GPIO_BACKENDS:
+        raise ConfigError(f'general.gpio_backend must be one of {", ".join(GPIO_BACKENDS)}')
+    if general.water_input_channel is not None:
+        if general.refill_timeout is None:
+            raise ConfigError('general.refill_timeout is required with water_input_channel')
+        if general.tank_refill_mode in ('level', 'ultrasonic') and general.refill_amount is None:
+            raise ConfigError(f'general.refill_amount is required for the {general.tank_refill_mode} refill mode')
+    ultrasonic = compile_ultrasonic(raw['ultrasonic']) if raw.get('ultrasonic') is not None else None
+    if general.tank_refill_mode == 'ultrasonic':
+        if ultrasonic is None:
+            raise ConfigError('ultrasonic section is required for the ultrasonic refill mode')
+        if general.refill_full_amount is None:
+            general = replace(general, refill_full_amount=max(row[1] for row in ultrasonic.geometry))
+        if general.refill_amount is not None and general.refill_amount >= general.refill_full_amount:
+            # The refill would start and stop again on every tick
+            raise ConfigError(f'general.refill_amount ({general.refill_amount}) must be below '
+                              f'refill_full_amount ({general.refill_full_amount})')
+
+    if not isinstance(raw.get('zones'), dict) or not raw['zones']:
+        raise ConfigError('zones section is required')
+    zones = []
+    for zone_name, zone_config in raw['zones'].items():
+        where = f'zones.{zone_name}'
+        if not isinstance(zone_config, dict):
+            raise ConfigError(f'{where} must be a mapping')
+        schedule = zone_config.get('schedule') or []
+        if not isinstance(schedule, list):
+            raise ConfigError(f'{where}.schedule must be a list')
+        if len(str(zone_name).encode()) > MAX_ZONE_NAME_SIZE:
+            raise ConfigError(f'{where} name must be at most {MAX_ZONE_NAME_SIZE} bytes long')
+        zones.append(Zone(
+            name=str(zone_name),
+            channel=_require(zone_config, 'channel', int, where),
+            schedule=tuple(compile_period(period, f'{where}.schedule[{i}]')
+                           for i, period in enumerate(schedule)),
+        ))
+
+    chan_list = [general.main_power_channel]
+    if general.water_input_channel is not None:
+        chan_list.append(general.water_input_channel)
+    chan_list.extend(zone.channel for zone in zones)
+    if ultrasonic is not None and {ultrasonic.trigger_pin, ultrasonic.echo_pin} & set(chan_list):
+        raise ConfigError('ultrasonic pins must not be used by relay outputs')
+    if len(set(chan_list)) != len(chan_list):
+        raise ConfigError(f'Output channels must be unique, got {chan_list}')
+    adc = compile_adc(raw['adc']) if raw.get('adc') is not None else None
+    inputs = compile_inputs(raw['inputs'], general) if raw.get('inputs') is not None else ()
+
+    return Config(general=general,
+                  zones=tuple(zones),
+                  zones_by_name={zone.name: zone for zone in zones},
+                  zones_by_channel={zone.channel: zone for zone in zones},
+                  chan_list=tuple(chan_list),
+                  adc=adc,
+                  ultrasonic=ultrasonic,
+                  inputs=inputs)
+
+def cache_path(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f'.{name}.cache')
+
+def load(path) -> Config:
+    '''
+    Load a YAML config, using the compiled form cached next to it when the
+    file content has not changed. Raises ConfigError for invalid configs.
+    '''
+    with open(path, 'rb') as stream:
+        content = stream.read()
+    digest = hashlib.sha256(content).hexdigest()
+    cache = cache_path(path)
+    try:
+        with open(cache, 'rb') as stream:
+            version, cached_digest, config = pickle.load(stream)
+        if version == CACHE_VERSION and cached_digest == digest:
+            return config
+    except Exception:
+        # Missing, stale or unreadable cache: compile from YAML
+        pass
+
+    try:
+        raw = yaml.safe_load(content)
+    except yaml.YAMLError as exc:
+        raise ConfigError(str(exc))
+    config = compile_config(raw)
+    try:
+        tmp_path = f'{cache}.tmp'
+        with open(tmp_path, 'wb') as stream:
+            pickle.dump((CACHE_VERSION, digest, config), stream, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache)
+    except OSError:
+        pass
+    return config
@@ -2,21 +2,25 @@
 
 import time
 import sys
-import yaml
 import json
 import os
 import signal
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import paho.mqtt.client as mqtt
 import threading
+import socket
 import requests
-try:
-    import RPi.GPIO as GPIO
-except ImportError:
-    GPIO = None  # Mock or fallback handled later
-
+from collections import OrderedDict
+import watering_config
+import watering_logic
+import watering_sensors
+import watering_gpio
+import watering_checkpoint
+import watering_acquisition
+import watering_status
+from watering_gpio import HIGH, LOW
 # I2C KeySens submersible liquid level sensor read through an ADS1115 ADC.
 # Sensor outputs 0 V (empty tank) up to 2.505 V (1000 liters / full tank).
 try:
@@ -30,10 +34,6 @@ except ImportError:
     AnalogIn = None
     ads1x15 = None
 
-# Level sensor calibration: voltage -> liters
-LEVEL_SENSOR_FULL_VOLTAGE = 2.505  # Voltage reported when the tank holds TANK_CAPACITY_LITERS
-TANK_CAPACITY_LITERS = 1000        # Liters at LEVEL_SENSOR_FULL_VOLTAGE
-
 #import RPi.GPIO as GPIO
 # dh - OFF
 # dl - ON
@@ -53,21 +53,203 @@ zones = {'zone1': 3,
         }
 '''
 
-def get_rain_status():
-    try:
-        response = requests.get(
-            "https://ha.jktu.org.ua/api/states/sensor.northwatering_rain",
-            headers={"Authorization": f"Bearer {os.getenv('HA_TOKEN', '')}"},
-        )
-        json_response = response.json()
-        rain_status = json_response["state"]
-        if rain_status == 'Yes':
-            return True
+class HAInputs:
+    """
+    Home Assistant entity states listed in the config inputs section.
+
+    HA pushes state changes over our MQTT connection (mqtt_statestream), so
+    a change wakes the main loop at once. The REST API is only asked once at
+    startup for entities that have not been pushed yet.
+    """
+
+    def __init__(self, ham):
+        self.ham = ham
+        self.states = {}  # input name -> state, None while unknown
+        self.topics = {}  # topic -> input name
+        self.subscribed = set()
+        self.changed = threading.Event()
+
+    def configure(self, inputs):
+        """Follow the inputs of a (re)loaded config."""
+        self.topics = {item.topic: item.name for item in inputs}
+        for item in inputs:
+            self.states.setdefault(item.name, None)
+            if item.topic not in self.subscribed:
+                self.subscribed.add(item.topic)
+                self.ham.mqtt_client.message_callback_add(item.topic, self.on_state)
+                self.ham.subscribe(item.topic)
+
+    def on_state(self, client, userdata, msg):
+        name = self.topics.get(msg.topic)
+        if name is None:
+            return
+        state = msg.payload.decode('utf-8', errors='replace').strip()
+        if state.startswith('"'):
+            try:
+                state = str(json.loads(state))
+            except ValueError:
+                pass
+        if self.states.get(name) != state:
+            logging.info(f'Input {name}: {state}')
+            self.states[name] = state
+            self.changed.set()
+
+    def seed(self, inputs, ha_url):
+        """Fetch the current state of inputs nothing was pushed for yet."""
+        for item in inputs:
+            if self.states.get(item.name) is not None:
+                continue
+            try:
+                response = requests.get(
+                    f"{ha_url}/api/states/{item.entity}",
+                    headers={"Authorization": f"Bearer {os.getenv('HA_TOKEN', '')}"},
+                    timeout=10,
+                )
+                response.raise_for_status()
+                state = str(response.json()["state"])
+            except Exception as e:
+                logging.error(f"Failed to get {item.entity} state: {e}")
+                continue
+            # A pushed state wins over the fetched one
+            if self.states.get(item.name) is None:
+                logging.info(f'Input {item.name}: {state}')
+                self.states[item.name] = state
+
+    def skip_watering(self, inputs):
+        """Names of the inputs that currently stop watering."""
+        return [item.name for item in inputs if item.skips_watering(self.states.get(item.name))]
+
+class MqttOutbox:
+    """
+    Disk-backed spool for outbound MQTT messages produced while the broker is
+    unreachable.
+
+    Messages are appended to a small spool file (fsync'ed in batches) and kept
+    in memory in publish order. Regular messages supersede each other per
+    topic, so only the latest state of every topic survives; required messages
+    (events, commands) are all kept.
+    """
+
+    def __init__(self, path, fsync_interval=5, fsync_batch=20, max_required=5000):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.max_required = max_required
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # key -> (topic, payload, required)
+        self.required_seq = 0
+        self.required_count = 0
+        self.spool = None
+        self.spool_records = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.load()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def load(self):
+        """Rebuild the pending queue from a spool left by a previous run."""
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as stream:
+                for line in stream:
+                    try:
+                        topic, payload, required = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the spool
+                        continue
+                    self._enqueue(topic, payload, required)
+            if self.pending:
+                logging.info(f'Loaded {len(self.pending)} outbound MQTT messages from {self.path}')
+        self._rewrite()
+
+    def _enqueue(self, topic, payload, required):
+        if required:
+            self.required_seq += 1
+            key = ('required', self.required_seq)
+            if self.required_count >= self.max_required:
+                dropped = next(k for k, entry in self.pending.items() if entry[2])
+                logging.warning(f'MQTT outbox is full, dropping {self.pending[dropped][0]} message')
+                del self.pending[dropped]
+                self.required_count -= 1
+            self.required_count += 1
         else:
-            return False
-    except Exception as e:
-        logging.error(f"Failed to get rain status: {e}")
-    return True
+            key = topic
+            self.pending.pop(key, None)
+        self.pending[key] = (topic, payload, required)
+
+    def put(self, topic, payload, required=False):
+        """Queue a message and append it to the spool."""
+        with self.lock:
+            self._enqueue(topic, payload, required)
+            self.spool.write(json.dumps([topic, payload, required]) + '\n')
+            self.spool.flush()
+            self.spool_records += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_batch or time.time() - self.last_sync > self.fsync_interval:
+                self._sync()
+
+    def pop(self):
+        """Take the oldest message out of the queue, or None if it is empty."""
+        with self.lock:
+            if not self.pending:
+                return None
+            item = self.pending.popitem(last=False)
+            if item[1][2]:
+                self.required_count -= 1
+            return item
+
+    def restore(self, item):
+        """Put back a message that could not be published."""
+        key, entry = item
+        with self.lock:
+            if key in self.pending:
+                # A newer state for the same topic was queued meanwhile
+                return
+            self.pending[key] = entry
+            self.pending.move_to_end(key, last=False)
+            if entry[2]:
+                self.required_count += 1
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.spool.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def compact(self):
+        """Rewrite the spool once superseded and delivered records dominate it."""
+        with self.lock:
+            if self.spool_records > 2 * len(self.pending) + self.fsync_batch or \
+                    (not self.pending and self.spool_records):
+                self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as stream:
+            for topic, payload, required in self.pending.values():
+                stream.write(json.dumps([topic, payload, required]) + '\n')
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, self.path)
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = open(self.path, 'a')
+        self.spool_records = len(self.pending)
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        # Called again from the main loop's finally after a signal shutdown
+        with self.lock:
+            if self.spool.closed:
+                return
+            self._sync()
+            self.spool.close()
 
 class HAMqtt:
     mqtt_host = os.getenv("MQTT_HOST", '')
@@ -77,6 +259,7 @@ class HAMqtt:
     connected = False
     reconnect_delay = 1
     max_reconnect_delay = 60
+    max_queued_messages = 100
     subscriptions = []
 
     def __init__(self):
@@ -85,8 +268,14 @@ class HAMqtt:
         if not all(REQUIRED_CONFIGS):
             logging.error("One or more required environment variables are missing.")
             exit(1)
+        # Messages produced while the broker is unreachable go to the outbox
+        # and are drained by a background thread once we are connected.
+        self.outbox = MqttOutbox(config.general.mqtt_outbox)
+        self.drain_rate = config.general.mqtt_drain_rate  # messages per second
+        self.outbox_event = threading.Event()
         self.mqtt_client = self.setup_mqtt_client()
         self.mqtt_client.loop_start()
+        threading.Thread(target=self.drain_outbox, daemon=True).start()
 
     def setup_mqtt_client(self) -> mqtt.Client:
         """Setup and return an MQTT client with reconnection support."""
@@ -94,7 +283,7 @@ class HAMqtt:
         # (clean_session=False). This makes the broker keep the session and
         # queue QoS 1 messages for us while we are disconnected, so commands
         # sent during a network drop are delivered once we reconnect.
-        client_id = f"watering_control_{config['general']['device_name']}"
+        client_id = f"watering_control_{config.general.device_name}"
         mqtt_client = mqtt.Client(
             mqtt.CallbackAPIVersion.VERSION1,
             client_id=client_id,
@@ -112,28 +301,16 @@ class HAMqtt:
             min_delay=self.reconnect_delay,
             max_delay=self.max_reconnect_delay,
         )
+        # Bound paho's in-memory queue, the outbox takes the overflow.
+        mqtt_client.max_queued_messages_set(self.max_queued_messages)
         
         mqtt_client.user_data_set(set())
         
-        # Initial connection
-        self.connect_with_retry(mqtt_client)
+        # Initial connection is made by the network loop, so an unreachable
+        # broker never blocks the caller.
+        mqtt_client.connect_async(self.mqtt_host)
         return mqtt_client
 
-    def connect_with_retry(self, mqtt_client):
-        """Attempt to connect to MQTT broker with exponential backoff."""
-        while not self.connected:
-            try:
-                mqtt_client.connect(self.mqtt_host)
-                logging.info("Connected to MQTT broker.")
-                self.connected = True
-                self.reconnect_delay = 1  # Reset delay on successful connection
-            except Exception as e:
-                logging.error(f"Failed to connect to MQTT broker: {e}")
-                logging.info(f"Retrying in {self.reconnect_delay} seconds...")
-                time.sleep(self.reconnect_delay)
-                # Exponential backoff with max delay
-                self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
-
     def on_connect(self, client, userdata, flags, rc):
         """Callback for MQTT on_connect event."""
         if rc == 0:
@@ -141,6 +318,7 @@ class HAMqtt:
             logging.info("Successfully connected to MQTT broker")
             # Resubscribe to all topics
             self.resubscribe_all()
+            self.outbox_event.set()
         else:
             self.connected = False
             logging.error(f"Failed to connect to MQTT broker. Reason code: {rc}")
@@ -169,31 +347,63 @@ class HAMqtt:
         """Callback for MQTT on_publish event."""
         userdata.discard(mid)
 
-    def send_data(self, topic: str, message: str):
-        """Send data to MQTT broker with connection check."""
-        if not self.connected:
-            logging.warning("MQTT not connected. Attempting to reconnect...")
-            self.connect_with_retry(self.mqtt_client)
-        
+    def publish(self, topic: str, message: str) -> bool:
+        """Hand a message over to paho. Returns False if it was not accepted."""
         try:
             result = self.mqtt_client.publish(topic, message, qos=1)
-            # In paho-mqtt 2.1.0, publish returns (result, mid)
-            if result[0] == mqtt.MQTT_ERR_SUCCESS:
+            # In paho-mqtt 2.1.0, publish returns (result, mid).
+            # MQTT_ERR_NO_CONN still keeps the message in paho's queue.
+            if result[0] in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
                 logging.debug(f"Published to {topic}: {message} (mid={result[1]})")
-            else:
-                logging.error(f"Failed to publish to {topic}. Return code: {result[0]}")
+                return True
+            logging.error(f"Failed to publish to {topic}. Return code: {result[0]}")
         except Exception as e:
             logging.error(f"Failed to publish to MQTT: {e}")
-            # Mark as disconnected to trigger reconnection
-            self.connected = False
+        return False
+
+    def send_data(self, topic: str, message: str, required: bool = False):
+        """
+        Send data to MQTT broker without blocking on its availability.
+        required - keep the message even if a newer one for the topic is sent
+        """
+        if self.connected and len(self.outbox) == 0:
+            if self.publish(topic, message):
+                return
+        logging.debug(f"MQTT not available. Queued {topic} message in the outbox")
+        self.outbox.put(topic, message, required)
+        self.outbox_event.set()
+
+    def drain_outbox(self):
+        """Publish queued messages at a controlled rate while connected."""
+        while True:
+            self.outbox_event.wait(self.outbox.fsync_interval)
+            self.outbox_event.clear()
+            self.outbox.sync()
+            drained = 0
+            while self.connected:
+                item = self.outbox.pop()
+                if item is None:
+                    break
+                topic, message, required = item[1]
+                if not self.publish(topic, message):
+                    self.outbox.restore(item)
+                    break
+                drained += 1
+                time.sleep(1 / self.drain_rate)
+            if drained:
+                logging.info(f"Drained {drained} messages from the MQTT outbox, {len(self.outbox)} left")
+            self.outbox.compact()
 
     def subscribe(self, topic: str):
         """Subscribe to a topic and track it for reconnection."""
+        if topic not in self.subscriptions:
+            self.subscriptions.append(topic)
         try:
             result = self.mqtt_client.subscribe(topic, qos=1)
             if result[0] == mqtt.MQTT_ERR_SUCCESS:
-                self.subscriptions.append(topic)
                 logging.debug(f"Subscribed to topic: {topic}")
+            elif result[0] == mqtt.MQTT_ERR_NO_CONN:
+                logging.debug(f"Not connected, {topic} will be subscribed on connect")
             else:
                 logging.error(f"Failed to subscribe to topic: {topic}")
         except Exception as e:
@@ -213,11 +423,10 @@ class HAMqtt:
             return False
 
     def check_connection_health(self):
-        """Check connection health and reconnect if necessary."""
+        """Check connection health. Reconnection is left to the network loop."""
         if not self.is_connected():
             self.connected = False
-            logging.warning("MQTT connection health check failed. Attempting to reconnect...")
-            self.connect_with_retry(self.mqtt_client)
+            logging.warning(f"MQTT connection health check failed, {len(self.outbox)} messages in the outbox")
             return False
         return True
 
@@ -238,6 +447,7 @@ class HAMqtt:
     def cleanup(self):
         self.mqtt_client.loop_stop()
         self.mqtt_client.disconnect()
+        self.outbox.close()
 
     def create_storage_sensor(self, device_name, zone_name):
         payload = {
@@ -289,6 +499,29 @@ class HAMqtt:
         config_topic = f"homeassistant/sensor/{device_name}/{zone_name}/config"
         self.send_data(config_topic, json.dumps(payload))
 
+    def create_measurement_sensor(self, device_name, zone_name, unit):
+        payload = {
+          "device": {
+            "identifiers": [
+              device_name
+            ],
+            "manufacturer": "JktuLTD",
+            "model": "WTR-01",
+            "name": device_name,
+            "serial_number": "01020304"
+          },
+          "name": zone_name,
+          "unit_of_measurement": unit,
+          "state_class": "measurement",
+          "object_id": f'{device_name}-{zone_name}',
+          "state_topic": f"watering/{device_name}/state",
+          "unique_id": f'{device_name}-{zone_name}',
+          "value_template": f"{{{{ value_json.{zone_name}_state }}}}",
+          "enabled_by_default": True
+        }
+        config_topic = f"homeassistant/sensor/{device_name}/{zone_name}/config"
+        self.send_data(config_topic, json.dumps(payload))
+
     def create_ha_sensor(self, device_name, zone_name):
         payload = {
           "device": {
@@ -344,21 +577,53 @@ class RPIWatering:
     output_pins = []
     main_power_pin = 9
     manual_execution = {}
-    water_flowtimer = 0
-    water_volume = 0
 
-    def __init__(self, output_pins, input_pins, main_power_pin):
+    def __init__(self, gpio, output_pins, input_pins, main_power_pin, adc=None, ultrasonic=None, initial_on=(),
+                 sensor_process=None):
+        '''
+        initial_on - outputs to start ON (restored from a checkpoint),
+        everything else starts OFF. Main power follows the other outputs.
+        sensor_process - SensorProcess reading the level sensors, which are
+        then not opened here
+        '''
+        self.gpio = gpio
+        self.lock = threading.Lock()
         self.output_pins = output_pins
         self.main_power_pin = main_power_pin
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.output_pins, GPIO.OUT, initial=GPIO.HIGH)
-        GPIO.setup(input_pins, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup([bobber_full_pin, bobber_low_pin], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        #GPIO.setup(high_level_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        #GPIO.setup(low_level_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # Set up the I2C level sensor (ADS1115 ADC, channel A0)
+        levels = {ch: LOW if ch in initial_on and ch != main_power_pin else HIGH for ch in self.output_pins}
+        if LOW in levels.values():
+            logging.info(f'Restoring ON outputs {sorted(ch for ch, level in levels.items() if level == LOW)}')
+            levels[main_power_pin] = LOW
+        self.gpio.setup_outputs(levels)
+        self.gpio.setup_inputs(input_pins)
+        self.gpio.setup_inputs([bobber_full_pin, bobber_low_pin])
+        logging.info(f"Using {self.gpio.name} GPIO backend.")
+        self.level_filter = watering_logic.LevelFilter()
+        # Calibration of the ADC tank channel, None for the default level sensor
+        self.tank_channel = next((channel for channel in adc.channels if channel.name == 'tank'), None) if adc else None
         self.level_channel = None
-        if busio is not None and ADS1115 is not None:
+        self.scanner = None
+        self.ultrasonic = None
+        self.sensor_process = sensor_process
+        self.cleaned_up = False
+        if sensor_process is not None:
+            logging.info("Level sensors are read by the sensor process.")
+        else:
+            self.setup_sensors(adc, ultrasonic)
+
+    def setup_sensors(self, adc, ultrasonic):
+        # Set up the I2C level sensor (ADS1115 ADC, channel A0)
+        if adc is not None and watering_sensors.SMBus is not None:
+            # Multi-channel scan engine, the 'tank' channel is the level sensor
+            try:
+                self.scanner = watering_sensors.ADS1115Scanner(adc, self.gpio)
+                self.scanner.start()
+            except Exception as e:
+                self.scanner = None
+                logging.error(f"Failed to start ADS1115 scanner: {e}")
+        elif adc is not None:
+            logging.warning("smbus2 not available. ADC channels disabled.")
+        elif busio is not None and ADS1115 is not None:
             try:
                 i2c = busio.I2C(board.SCL, board.SDA)
                 ads = ADS1115(i2c)
@@ -368,60 +633,80 @@ class RPIWatering:
                 logging.error(f"Failed to initialize I2C level sensor: {e}")
         else:
             logging.warning("adafruit_ads1x15 not available. Level sensor disabled.")
-        self.water_volume = 0
-        self.water_flowtimer = 0
-        self.volume_history = []
-        self.VOLUME_HISTORY_SIZE = 3
-        for ch in self.output_pins:
-            self.set_status_rpi(ch, True) #OFF
+        if ultrasonic is not None:
+            try:
+                self.ultrasonic = watering_sensors.UltrasonicSensor(ultrasonic)
+                self.ultrasonic.start()
+            except Exception as e:
+                self.ultrasonic = None
+                logging.error(f"Failed to initialize ultrasonic level sensor: {e}")
 
     def get_water_amount(self, max_attempts=20):
+        if self.sensor_process is not None:
+            return self.get_shared_water_amount()
+        if self.ultrasonic is not None:
+            distance = self.ultrasonic.measure()
+            if distance is None:
+                logging.warning('Ultrasonic sensor returned no valid pings, using cached values')
+            return self.level_filter.update_distance(distance, self.ultrasonic.ultrasonic.geometry, time.time())
+        if self.scanner is not None:
+            # The scanner keeps sampling in the background, use its latest readings
+            voltage_stat = []
+            if 'tank' in self.scanner.channels:
+                voltage_stat = [v for v in self.scanner.voltages('tank')
+                                if watering_logic.is_valid_voltage(v, self.tank_channel)][-5:]
+            if len(voltage_stat) == 0:
+                logging.warning('ADC tank channel has no valid readings, using cached values')
+            return self.level_filter.update(voltage_stat, time.time(), self.tank_channel)
         voltage_stat = []
         attempts = 0
         while attempts < max_attempts:
             attempts += 1
             voltage = self.get_voltage()
-            # Accept readings within the sensor's operating range
-            # (allow a small margin for noise around the empty/full ends).
-            if voltage is not None and -0.05 <= voltage <= LEVEL_SENSOR_FULL_VOLTAGE + 0.1:
+            if watering_logic.is_valid_voltage(voltage):
                 voltage_stat.append(voltage)
             if len(voltage_stat) >= 5:
                 break
 
         if len(voltage_stat) == 0:
             logging.warning(f'Sensor returned no valid readings after {max_attempts} attempts, using cached values')
-            return (self.water_volume, 0)
-
-        if len(voltage_stat) < 5:
+        elif len(voltage_stat) < 5:
             logging.warning(f'Sensor returned only {len(voltage_stat)} valid readings out of {attempts} attempts')
+        return self.level_filter.update(voltage_stat, time.time())
 
-        voltage = sum(voltage_stat) / len(voltage_stat)
-        voltage = round(voltage, 4)
-        # Convert voltage to liters: 0 V = empty, 2.505 V = 1000 liters
-        amount = (voltage / LEVEL_SENSOR_FULL_VOLTAGE) * TANK_CAPACITY_LITERS
-        # Clamp to the physical range of the tank
-        amount = max(0, min(TANK_CAPACITY_LITERS, amount))
-        amount = round(amount, 0)
-
-        # Smooth volume using moving average to filter sensor noise
-        self.volume_history.append(amount)
-        if len(self.volume_history) > self.VOLUME_HISTORY_SIZE:
-            self.volume_history.pop(0)
-        smoothed_amount = round(sum(self.volume_history) / len(self.volume_history), 0)
-
-        old_flowtimer = self.water_flowtimer
-        now = round(time.time())
-        old_volume = self.water_volume
-        self.water_flowtimer = now
-        self.water_volume = smoothed_amount
-        water_flow = 0
-        if old_flowtimer > 0:
-            time_diff = now - old_flowtimer
-            if time_diff > 0:
-                water_diff = smoothed_amount - old_volume
-                water_flow = round((water_diff / time_diff) * 60)
-        logging.info(f'Voltage: {voltage} V, Volume: {smoothed_amount} liters, Water flow: {water_flow} l/min')
-        return (smoothed_amount, water_flow)
+    def get_shared_water_amount(self):
+        '''Tank volume and flow from the latest readings of the sensor process.'''
+        readings = self.sensor_process.fresh()
+        if readings is None:
+            logging.warning('No recent readings from the sensor process, using cached values')
+        now = readings.measured_at if readings is not None else time.time()
+        ultrasonic = self.sensor_process.ultrasonic
+        if ultrasonic is not None:
+            distance = readings.distance if readings is not None else None
+            return self.level_filter.update_distance(distance, ultrasonic.geometry, now)
+        voltage_stat = []
+        if readings is not None:
+            voltage_stat = [v for v in readings.voltages if watering_logic.is_valid_voltage(v, self.tank_channel)][-5:]
+            if len(voltage_stat) == 0:
+                logging.warning('Sensor process has no valid level readings, using cached values')
+        return self.level_filter.update(voltage_stat, now, self.tank_channel)
+
+    def get_adc_values(self):
+        '''Calibrated values of the ADC channels other than the tank level.'''
+        res = {}
+        if self.sensor_process is not None and self.sensor_process.adc is not None:
+            readings = self.sensor_process.fresh()
+            if readings is not None:
+                for channel, value in zip(self.sensor_process.adc.channels, readings.values):
+                    if channel.name != 'tank' and value is not None:
+                        res[f'{channel.name}_state'] = round(value, 1)
+            return res
+        if self.scanner is not None:
+            for name in self.scanner.channels:
+                value = self.scanner.value(name)
+                if name != 'tank' and value is not None:
+                    res[f'{name}_state'] = round(value, 1)
+        return res
 
     def get_voltage(self):
         """Read the level sensor voltage from the ADS1115 ADC (channel A0)."""
@@ -434,7 +719,7 @@ class RPIWatering:
             return None
 
     def get_status(self, channel):
-        ch_status = GPIO.input(channel)
+        ch_status = self.gpio.read(channel)
         if ch_status == 0:
             return True
         if ch_status == 1:
@@ -442,12 +727,12 @@ class RPIWatering:
 
     def get_all_status(self, zones):
         res={}
-        for zone_name, zone_config in zones.items():
-            status = self.get_status(zone_config['channel'])
+        for zone in zones:
+            status = self.get_status(zone.channel)
             if status == True:
-                res[f'{zone_name}_state'] = 'ON'
+                res[f'{zone.name}_state'] = 'ON'
             if status == False:
-                res[f'{zone_name}_state'] = 'OFF'
+                res[f'{zone.name}_state'] = 'OFF'
         return res
 
     def get_input_status(self, input_channel):
@@ -464,8 +749,8 @@ class RPIWatering:
         bobber_full_pin HI  -> tank is full          -> 'high'
         bobber_low_pin  HI  -> water level < 600 L    -> 'low'
         '''
-        full = GPIO.input(bobber_full_pin)
-        low = GPIO.input(bobber_low_pin)
+        full = self.gpio.read(bobber_full_pin)
+        low = self.gpio.read(bobber_low_pin)
         if full == 1:
             return 'high'
         if low == 1:
@@ -473,11 +758,6 @@ class RPIWatering:
         # Neither pin asserted (level between thresholds): keep last known meaning
         return 'middle'
 
-    def set_status_rpi(self, channel, status):
-        #GPIO.output(ch, True) #OFF
-        GPIO.output(channel, status)
-        return True
-
     def set_status(self, channel, status):
         '''
         channel - pin number
@@ -485,70 +765,71 @@ class RPIWatering:
         '''
         logging.info(f'Check {channel} is in {status}')
         if self.get_status(channel) != status:
-            logging.info(f'Switching {channel} to {status}')
-            if status == True:
-                self.set_status_rpi(channel, False)
-            if status == False:
-                self.set_status_rpi(channel, True)
-            self.check_main_power()
-        return True
-
-    def check_main_power(self):
-        target_status = False
-        for ch in self.output_pins:
-            if ch != self.main_power_pin:
-                if self.get_status(ch) == True:
-                    target_status = True
-        if self.get_status(self.main_power_pin) != target_status:
-            logging.info(f'Set main power {self.main_power_pin} to {target_status}')
-            if target_status == True:
-                self.set_status_rpi(self.main_power_pin, False)
-            if target_status == False:
-                self.set_status_rpi(self.main_power_pin, True)
-
-    def cleanup():
-        GPIO.cleanup()
-
-class RPIWateringTest:
-    states = {}
-
-    def get_status(self, channel):
+            self.apply({channel: status})
         return True
 
-    def set_status_rpi(self, channel, status):
-        #GPIO.output(ch, True) #OFF
-        GPIO.output(channel, status)
-        return True
+    def apply(self, changes):
+        '''
+        Switch the outputs in changes ({channel: True = ON}) together with
+        the main power, which is ON while any other output is ON. Outputs
+        not in changes keep their current state. All changed levels go out
+        in one group write. Backends writing pin by pin get them in an order
+        that never runs the pump against closed valves.
+        '''
+        # MQTT commands and the main loop switch outputs from different threads
+        with self.lock:
+            states = self.get_states()
+            states.update((ch, status) for ch, status in changes.items() if ch != self.main_power_pin)
+            target_status = any(states.values())
+            switch_main_power = self.get_status(self.main_power_pin) != target_status
+            levels = {}
+            if switch_main_power:
+                logging.info(f'Set main power {self.main_power_pin} to {target_status}')
+                if target_status == False:
+                    # Main power goes off first
+                    levels[self.main_power_pin] = HIGH
+            for ch, status in changes.items():
+                if ch != self.main_power_pin and self.get_status(ch) != status:
+                    logging.info(f'Switching {ch} to {status}')
+                    levels[ch] = LOW if status else HIGH
+            if switch_main_power and target_status == True:
+                # and comes on last
+                levels[self.main_power_pin] = LOW
+            if levels:
+                self.gpio.write_group(levels)
 
-    def set_status(self, channel, status):
-        print('T1')
-        if channel in self.states:
-            #print(f'{channel} state in the mapping')
-            current_state = self.states[channel]
-            if current_state != status:
-                logging.info(f'Set {channel} channel to {status}')
-                self.states[channel] = status
-        else:
-            logging.info(f'Set {channel} channel to {status}')
-            self.states[channel] = status
-        return True
+    def get_states(self):
+        '''{channel: True = ON} of every output except main power.'''
+        return {ch: self.get_status(ch) for ch in self.output_pins if ch != self.main_power_pin}
 
-    def cleanup():
-        return True
+    def all_off(self):
+        '''
+        Fail-safe: switch every output OFF without reading pins back.
+        Main power goes first so the pump never runs against closed valves.
+        '''
+        levels = {self.main_power_pin: HIGH}
+        for ch in self.output_pins:
+            levels[ch] = HIGH
+        self.gpio.write_group(levels)
 
-def is_current_time_in_interval(day: str, time_str: str, duration: int) -> bool:
-    now = datetime.now()    
-    days_map = {'Mon': 0, 'Tue': 1, 'Wed': 2, 'Thu': 3, 'Fri': 4, 'Sat': 5, 'Sun': 6}
-    target_weekday = days_map.get(day)
-    if target_weekday is None:
-        raise ValueError(f"Invalid day string: {day}")
-    today_weekday = now.weekday()
-    days_difference = (target_weekday - today_weekday) % 7
-    interval_start_date = now.date() + timedelta(days=days_difference)
-    interval_start_time = datetime.strptime(time_str, '%H:%M').time()
-    interval_start = datetime.combine(interval_start_date, interval_start_time)
-    interval_end = interval_start + timedelta(minutes=duration)
-    return interval_start <= now <= interval_end
+    def cleanup(self):
+        # A signal shutdown cleans up in the handler and again in the main loop's finally
+        if self.cleaned_up:
+            return
+        self.cleaned_up = True
+        if self.sensor_process is not None:
+            self.sensor_process.stop()
+        if self.scanner is not None:
+            self.scanner.stop()
+        if self.ultrasonic is not None:
+            self.ultrasonic.cleanup()
+        # Freeing the lines does not reset them: lgpio leaves them at their
+        # last level, so switch the relays OFF before letting go of the pins
+        try:
+            self.all_off()
+        except Exception as e:
+            logging.error(f"Failed to switch outputs OFF on cleanup: {e}")
+        self.gpio.cleanup()
 
 def get_water_level():
     high_level_bin = rpi.get_status(high_level_pin)
@@ -571,7 +852,10 @@ def on_message(mqttc, obj, msg):
     logging.debug("Got new MQTT message "+msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
     zone=msg.topic.split('/')[2]
     command = msg.payload.decode('utf-8')
-    ch = config['zones'][zone]['channel']
+    if zone not in config.zones_by_name:
+        logging.warning(f'Got command for unknown zone {zone}')
+        return
+    ch = config.zones_by_name[zone].channel
     logging.info(f'Set {zone} zone ({ch}) to {str(command)}')
     if str(command) == 'ON':
         rpi.set_status(ch, True)
@@ -579,9 +863,10 @@ def on_message(mqttc, obj, msg):
     if str(command) == 'OFF':
         rpi.set_status(ch, False)
         blocked_zones.pop(zone, None)
+    save_checkpoint()
 
     status_to_send = {}
-    if config['general'].get('water_input_channel', '')!= '':
+    if config.general.water_input_channel is not None:
         low_level = rpi.get_status(low_level_pin)
         high_level = rpi.get_status(high_level_pin)
         rain_detect = rpi.get_status(rain_pin)
@@ -602,22 +887,20 @@ def on_message(mqttc, obj, msg):
         else:
             status_to_send['high_water_state'] = 'No'
         status_to_send['bobber_state'] = rpi.get_bobber_state()
-    status_to_send = status_to_send | rpi.get_all_status(config['zones'])
+    status_to_send = status_to_send | rpi.get_all_status(config.zones)
     logging.debug(f'watering/{device_name}/state message: {json.dumps(status_to_send)}')
-    threading.Thread(target=lambda: ham.send_data(f'watering/{device_name}/state', json.dumps(status_to_send))).start()
-    #ham.send_data(f'watering/{device_name}/state', json.dumps(status_to_send))
+    ham.send_data(f'watering/{device_name}/state', json.dumps(status_to_send))
+    update_status(status_to_send)
     logging.debug('on_message is done')
     #logger.info(json.dumps(status_to_send))
     #ham.send_data(f'watering/{device_name}/state', json.dumps(status_to_send))
-    #rpi.set_status(zone_config['channel'], current_needs)
 
 def load_config():
-    with open(sys.argv[1]) as stream:
-        try:
-            config = yaml.safe_load(stream)
-            return config
-        except yaml.YAMLError as exc:
-            logging.critical(exc)
+    '''Load and validate the config, None if it is broken.'''
+    try:
+        return watering_config.load(sys.argv[1])
+    except (OSError, watering_config.ConfigError) as exc:
+        logging.critical(f'Failed to load config {sys.argv[1]}: {exc}')
 
 log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 log_handler = TimedRotatingFileHandler(
@@ -634,16 +917,16 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(log_handler)
 rpi = ''
 config = load_config()
+if config is None:
+    sys.exit(1)
 ham = HAMqtt()
 ham.mqtt_client.on_message = on_message
-device_name = config['general']['device_name']
-chan_list = []
-chan_list.append(config['general']['main_power_channel'])
-if config['general'].get('water_input_channel', '')!= '':
-    chan_list.append(config['general']['water_input_channel'])
-for zone_name, zone_config in config['zones'].items():
-    chan_list.append(zone_config['channel'])
-    ham.create_ha_device(device_name, zone_name)
+ha_inputs = HAInputs(ham)
+ha_inputs.configure(config.inputs)
+device_name = config.general.device_name
+chan_list = list(config.chan_list)
+for zone in config.zones:
+    ham.create_ha_device(device_name, zone.name)
 ham.create_ha_sensor(device_name, 'high_water')
 ham.create_ha_sensor(device_name, 'low_water')
 ham.create_ha_sensor(device_name, 'rain')
@@ -651,14 +934,176 @@ ham.create_ha_sensor(device_name, 'input_water')
 ham.create_ha_sensor(device_name, 'bobber')
 ham.create_storage_sensor(device_name, 'storage')
 ham.create_flow_sensor(device_name, 'flow')
-if GPIO:
-    rpi = RPIWatering(chan_list, [high_level_pin, low_level_pin, rain_pin], config['general']['main_power_channel'])
-else:
-    logging.info("RPi.GPIO not available. Using test mode.")
-    rpi = RPIWateringTest()
-blocked_zones = {}
-cached_water_amount = 0
-cached_water_flow = 0
+if config.adc is not None:
+    for adc_channel in config.adc.channels:
+        if adc_channel.name != 'tank':
+            ham.create_measurement_sensor(device_name, adc_channel.name, adc_channel.unit)
+# Warm restart: pick up the state of the previous process if it is recent
+checkpoint = watering_checkpoint.Checkpoint(config.general.checkpoint)
+restored = checkpoint.load(config.general.checkpoint_max_age) or watering_checkpoint.ControllerState()
+if restored.written_at:
+    logging.info(f'Restoring controller state saved {round(time.time() - restored.written_at)}s ago')
+sensor_process = None
+if config.general.sensor_process:
+    # The child opens its own pins. Restarts fork from the running controller,
+    # so the child also inherits its GPIO, MQTT and log file handles; it never
+    # uses them and drops the log handlers first thing
+    sensor_process = watering_acquisition.SensorProcess(config.adc, config.ultrasonic, config.general.gpio_backend,
+                                                        config.general.sensor_interval, config.general.sensor_timeout)
+    sensor_process.start()
+rpi = RPIWatering(watering_gpio.create_backend(config.general.gpio_backend),
+                  chan_list, [high_level_pin, low_level_pin, rain_pin], config.general.main_power_channel,
+                  adc=config.adc, ultrasonic=config.ultrasonic, initial_on=restored.outputs,
+                  sensor_process=sensor_process)
+rpi.level_filter.water_volume = restored.water_volume
+rpi.level_filter.water_flowtimer = restored.water_flowtimer
+rpi.level_filter.volume_history = restored.volume_history
+blocked_zones = {zone: since for zone, since in restored.blocked_zones.items() if zone in config.zones_by_name}
+refill = watering_logic.RefillController()
+planner = watering_logic.TransitionPlanner()
+refill.refill_timer = restored.refill_timer
+cached_water_amount = restored.cached_water_amount
+cached_water_flow = restored.cached_water_flow
+
+def save_checkpoint(outputs=None):
+    '''outputs - pins to record as ON, by default the ones that are ON now'''
+    if outputs is None:
+        outputs = {ch for ch in chan_list if rpi.get_status(ch)}
+    checkpoint.save(watering_checkpoint.ControllerState(
+        refill_timer=refill.refill_timer,
+        water_volume=rpi.level_filter.water_volume,
+        water_flowtimer=rpi.level_filter.water_flowtimer,
+        cached_water_amount=cached_water_amount,
+        cached_water_flow=cached_water_flow,
+        volume_history=rpi.level_filter.volume_history,
+        outputs=outputs,
+        blocked_zones=blocked_zones,
+    ))
+
+def fail_safe():
+    '''Switch every relay OFF and make sure a restart does not switch them back on.'''
+    rpi.all_off()
+    save_checkpoint(outputs=set())
+
+status_snapshot = watering_status.StatusSnapshot()
+status_fields = {}
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+def update_status(status_to_send):
+    '''Refresh the local status API snapshot from a state message, without reading any pins.'''
+    # on_message sends fewer fields than the main loop, keep the others
+    status_fields.update(status_to_send)
+    status_to_send = status_fields
+    now = time.time()
+    zones = {}
+    for zone in config.zones:
+        transition = watering_logic.next_transition(zone, now)
+        zones[zone.name] = {
+            'channel': zone.channel,
+            'state': status_to_send.get(f'{zone.name}_state'),
+            'blocked_since': format_time(blocked_zones[zone.name]) if zone.name in blocked_zones else None,
+            'next_transition': None if transition is None else {
+                'time': format_time(transition[0]),
+                'state': 'ON' if transition[1] else 'OFF',
+            },
+        }
+    data = {
+        'device': device_name,
+        'zones': zones,
+        'inputs': dict(ha_inputs.states),
+        'skip_watering': ha_inputs.skip_watering(config.inputs),
+        'pump_cycles_avoided': planner.avoided_pump_cycles,
+    }
+    if config.general.water_input_channel is not None:
+        data['tank'] = {
+            'volume': cached_water_amount,
+            'flow': cached_water_flow,
+            'low_level': status_to_send.get('low_water_state'),
+            'high_level': status_to_send.get('high_water_state'),
+            'bobber': status_to_send.get('bobber_state'),
+        }
+        data['refill'] = {
+            'mode': config.general.tank_refill_mode,
+            'water_input': status_to_send.get('input_water_state'),
+            'since': format_time(refill.refill_timer) if refill.refill_timer else None,
+        }
+    if config.adc is not None:
+        data['adc'] = {channel.name: status_to_send.get(f'{channel.name}_state')
+                       for channel in config.adc.channels if channel.name != 'tank'}
+    status_snapshot.update(data)
+
+def sd_notify(state):
+    '''Send a state notification to systemd. No-op when not run as a Type=notify unit.'''
+    address = os.getenv('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+        return True
+    except OSError as e:
+        logging.error(f'Failed to notify systemd: {e}')
+        return False
+
+class LoopSupervisor:
+    '''
+    Watches the main loop from its own thread. Every iteration has to call
+    kick() before the previous deadline expires, otherwise all relays are
+    driven OFF and the systemd watchdog is no longer fed, so systemd restarts
+    the service.
+    '''
+    check_interval = 1
+
+    def __init__(self, fail_safe):
+        self.fail_safe = fail_safe
+        self.deadline = None
+        self.last_kick = time.monotonic()
+        self.tripped = False
+        # systemd asks for pings at least every WATCHDOG_USEC, use half of it
+        watchdog_usec = os.getenv('WATCHDOG_USEC')
+        self.watchdog_interval = int(watchdog_usec) / 2e6 if watchdog_usec else None
+        self.last_ping = 0
+
+    def start(self, deadline):
+        self.kick(deadline)
+        threading.Thread(target=self.run, daemon=True).start()
+        sd_notify('READY=1')
+
+    def kick(self, deadline):
+        '''Start a new iteration, which has to finish within deadline seconds.'''
+        self.deadline = deadline
+        self.last_kick = time.monotonic()
+        if self.tripped:
+            logging.warning('Main loop recovered after missing its deadline')
+            self.tripped = False
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+            now = time.monotonic()
+            if now - self.last_kick > self.deadline:
+                if not self.tripped:
+                    self.tripped = True
+                    logging.critical(f'Main loop missed its {self.deadline}s deadline. Switching all relays OFF')
+                    try:
+                        self.fail_safe()
+                    except Exception as e:
+                        logging.critical(f'Fail-safe failed: {e}')
+                continue
+            if self.watchdog_interval and now - self.last_ping >= self.watchdog_interval:
+                sd_notify('WATCHDOG=1')
+                self.last_ping = now
+
+def send_event(event, water_amount):
+    '''Publish a controller event. Events are never superseded in the MQTT outbox.'''
+    message = {'event': event, 'storage': water_amount, 'time': datetime.now().isoformat(timespec='seconds')}
+    ham.send_data(f'watering/{device_name}/event', json.dumps(message), required=True)
 
 def signal_handler(signum, frame):
     """Handle shutdown signals gracefully."""
@@ -677,27 +1122,45 @@ def main():
 
         #GPIO.output(9, False) # Main power ON
         #GPIO.output(2, False) # Water input ON
-        refill_timer = 0
         config_reload_timer = time.time()
         mqtt_health_check_timer = time.time()
-        config = load_config()
+        global config
+        ha_inputs.seed(config.inputs, config.general.ha_url)
+        if config.general.status_port is not None or config.general.status_socket is not None:
+            try:
+                watering_status.start(status_snapshot, config.general.status_port, config.general.status_socket)
+            except OSError as e:
+                logging.error(f'Failed to start the status API: {e}')
+        supervisor = LoopSupervisor(fail_safe)
+        supervisor.start(config.general.sleep_time + config.general.loop_deadline)
         while True:
+            supervisor.kick(config.general.sleep_time + config.general.loop_deadline)
             logging.debug('Main loop started')
-            if time.time() - config_reload_timer > config['general']['config_reload_timeout']*60:
-                config = load_config()
+            if time.time() - config_reload_timer > config.general.config_reload_timeout*60:
+                # A broken config is rejected and the previous one is kept
+                config = load_config() or config
+                ha_inputs.configure(config.inputs)
                 config_reload_timer = time.time()
             
+            if rpi.sensor_process is not None:
+                rpi.sensor_process.check()
+
             # MQTT connection health check every 30 seconds
             if time.time() - mqtt_health_check_timer > 30:
                 ham.check_connection_health()
                 mqtt_health_check_timer = time.time()
             
-            rain_status = get_rain_status()
+            skip_inputs = ha_inputs.skip_watering(config.inputs)
+            rain_status = len(skip_inputs) > 0
             if rain_status == True:
+                logging.info(f'Watering stopped by {", ".join(skip_inputs)}')
                 logging.info('Rain detected. No need watering.')
             status_to_send = {}
+            # Target output states of this tick, applied together below
+            targets = {}
             # Handle water input needs
-            if config['general'].get('water_input_channel', '')!= '':
+            general = config.general
+            if general.water_input_channel is not None:
                 global cached_water_amount, cached_water_flow
                 water_amount, water_flow = rpi.get_water_amount()
                 cached_water_amount = water_amount
@@ -726,59 +1189,31 @@ def main():
                 bobber_state = rpi.get_bobber_state()
                 status_to_send['bobber_state'] = bobber_state
                 logging.info(f"Bobber: {bobber_state}")
-                tank_refill_mode = config['general'].get('tank_refill_mode', 'level')
-                #if low_level == False and high_level == False:
-                if tank_refill_mode == 'bobber':
-                    start_refill = bobber_state == 'low'
-                    stop_refill = bobber_state == 'high'
-                else:
-                    # Level-sensor based refill (I2C KeySens via ADS1115)
-                    start_refill = water_amount < config['general']['refill_amount'] and high_level == False
-                    stop_refill = high_level == True
-                if start_refill:
-                    logging.info('Start refill')
-                    refill_timer = time.time()
-                    #rpi.set_status(9, True) # Main power ON
-                    rpi.set_status(config['general']['water_input_channel'], True) # Water input ON
-                    #status_to_send['input_water_state'] = 'Yes'
-                if refill_timer > 0 and time.time() - refill_timer > config['general']['refill_timeout']*60:
-                    logging.info('Force stop refill')
-                    refill_timer = 0
-                    rpi.set_status(config['general']['water_input_channel'], False) # Water input OFF
-                    #status_to_send['input_water_state'] = 'No'
-                if stop_refill:
-                    logging.info('Stop refill')
-                    refill_timer = 0
-                    rpi.set_status(config['general']['water_input_channel'], False) # Water input OFF
-                    #rpi.set_status(9, False) # Main power OFF
-                    #status_to_send['input_water_state'] = 'No'
-                status_to_send['input_water_state'] = rpi.get_input_status(config['general']['water_input_channel'])
-
-            for zone_name, zone_config in config['zones'].items():
-                logging.info(zone_name)
-                if zone_name in blocked_zones:
-                    if time.time() - blocked_zones[zone_name] > config['general']['blocking_timeout']*60:
-                        logging.info(f'Force unblock zone {zone_name}')
-                        blocked_zones.pop(zone_name)
-                    else:
-                        logging.info(f'{zone_name} zone is blocked')
-                        continue
-                current_needs = False
-                for period in zone_config.get('schedule', []):
-                    #print(period)
-                    need_watering = is_current_time_in_interval(period['day'], 
-                                                                period['time'], 
-                                                                period['duration'])
-                    if need_watering == True and rain_status == False:
-                        logging.info(f'{zone_name} zone needs watering')
-                        current_needs = True
-                rpi.set_status(zone_config['channel'], current_needs)
-
-            status_to_send = status_to_send | rpi.get_all_status(config['zones'])
+                for event, status in refill.step(general, time.time(), water_amount, high_level, bobber_state):
+                    if event:
+                        send_event(event, water_amount)
+                    targets[general.water_input_channel] = status # Water input ON/OFF
+
+            for zone_name, status in watering_logic.zone_targets(config, blocked_zones, rain_status, time.time()).items():
+                targets[config.zones_by_name[zone_name].channel] = status
+            # Make before break: open new valves, wait the overlap, close the old ones
+            for i, changes in enumerate(planner.plan(rpi.get_states(), targets)):
+                if i > 0 and general.valve_overlap:
+                    time.sleep(general.valve_overlap)
+                rpi.apply(changes)
+            if general.water_input_channel is not None:
+                status_to_send['input_water_state'] = rpi.get_input_status(general.water_input_channel)
+
+            status_to_send = status_to_send | rpi.get_adc_values()
+            status_to_send = status_to_send | rpi.get_all_status(config.zones)
             #logger.info(f'watering/{device_name}/state message: {json.dumps(status_to_send)}')
             ham.send_data(f'watering/{device_name}/state', json.dumps(status_to_send))
+            update_status(status_to_send)
+            save_checkpoint()
             logging.debug('Main loop done')
-            time.sleep(config['general']['sleep_time'])
+            # An input state change starts the next iteration right away
+            ha_inputs.changed.wait(general.sleep_time)
+            ha_inputs.changed.clear()
 
     except KeyboardInterrupt:
         logging.info("Received keyboard interrupt. Shutting down...")
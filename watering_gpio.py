@@ -0,0 +1,169 @@
+import logging
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+
+# Pin levels. Relays are active low: HIGH = OFF, LOW = ON.
+HIGH = 1
+LOW = 0
+
+
+class GPIOBackend:
+    '''
+    Pin access used by RPIWatering. Pins are BCM numbers.
+    write_group() gets the new levels of several outputs in the order they
+    have to change; backends that can switch them at once do so.
+    '''
+    name = ''
+
+    def setup_outputs(self, levels):
+        '''Claim {pin: initial level} as outputs.'''
+        raise NotImplementedError
+
+    def setup_inputs(self, pins):
+        '''Inputs with pull-ups.'''
+        raise NotImplementedError
+
+    def read(self, pin):
+        raise NotImplementedError
+
+    def write(self, pin, level):
+        self.write_group({pin: level})
+
+    def write_group(self, levels):
+        raise NotImplementedError
+
+    def add_falling_edge_callback(self, pin, callback):
+        '''Configure pin as a pulled-up input and call callback() on falling edges.'''
+        raise NotImplementedError
+
+    def cleanup(self):
+        pass
+
+class RPiGPIOBackend(GPIOBackend):
+    '''RPi.GPIO, one call per pin.'''
+    name = 'rpi'
+
+    def __init__(self):
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_outputs(self, levels):
+        for pin, level in levels.items():
+            GPIO.setup(pin, GPIO.OUT, initial=level)
+
+    def setup_inputs(self, pins):
+        GPIO.setup(list(pins), GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def read(self, pin):
+        return GPIO.input(pin)
+
+    def write_group(self, levels):
+        for pin, level in levels.items():
+            GPIO.output(pin, level)
+
+    def add_falling_edge_callback(self, pin, callback):
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.FALLING, callback=lambda channel: callback())
+
+    def cleanup(self):
+        GPIO.cleanup()
+
+class LgpioBackend(GPIOBackend):
+    '''
+    lgpio on /dev/gpiochip0. All outputs are claimed as one group, so
+    write_group() applies a new relay state with a single group_write call.
+    '''
+    name = 'lgpio'
+
+    def __init__(self, chip=0):
+        self.handle = lgpio.gpiochip_open(chip)
+        self.group = []
+        self.levels = {}
+        self.callbacks = []
+
+    def setup_outputs(self, levels):
+        self.group = list(levels)
+        lgpio.group_claim_output(self.handle, self.group, list(levels.values()))
+        self.levels = dict(levels)
+
+    def setup_inputs(self, pins):
+        for pin in pins:
+            lgpio.gpio_claim_input(self.handle, pin, lgpio.SET_PULL_UP)
+
+    def read(self, pin):
+        # Output levels are only ever changed by us, no need to ask the kernel
+        if pin in self.levels:
+            return self.levels[pin]
+        return lgpio.gpio_read(self.handle, pin)
+
+    def write_group(self, levels):
+        bits = 0
+        mask = 0
+        for i, pin in enumerate(self.group):
+            if pin in levels:
+                mask |= 1 << i
+                if levels[pin]:
+                    bits |= 1 << i
+        lgpio.group_write(self.handle, self.group[0], bits, mask)
+        self.levels.update(levels)
+
+    def add_falling_edge_callback(self, pin, callback):
+        lgpio.gpio_claim_alert(self.handle, pin, lgpio.FALLING_EDGE, lgpio.SET_PULL_UP)
+        self.callbacks.append(lgpio.callback(self.handle, pin, lgpio.FALLING_EDGE,
+                                             lambda chip, gpio, level, tick: callback()))
+
+    def cleanup(self):
+        for cb in self.callbacks:
+            cb.cancel()
+        if self.group:
+            lgpio.group_free(self.handle, self.group[0])
+        lgpio.gpiochip_close(self.handle)
+
+class SimulatedBackend(GPIOBackend):
+    '''In-memory pins for running without hardware. Inputs read as pulled up.'''
+    name = 'sim'
+
+    def __init__(self):
+        self.levels = {}
+
+    def setup_outputs(self, levels):
+        self.levels.update(levels)
+
+    def setup_inputs(self, pins):
+        for pin in pins:
+            self.levels.setdefault(pin, HIGH)
+
+    def read(self, pin):
+        return self.levels.get(pin, HIGH)
+
+    def write_group(self, levels):
+        logging.debug(f'Simulated GPIO write: {levels}')
+        self.levels.update(levels)
+
+    def add_falling_edge_callback(self, pin, callback):
+        self.levels.setdefault(pin, HIGH)
+
+def create_backend(name='auto'):
+    '''Pick a GPIO backend. 'auto' prefers lgpio, then RPi.GPIO, then simulation.'''
+    if name == 'lgpio':
+        return LgpioBackend()
+    if name == 'rpi':
+        return RPiGPIOBackend()
+    if name == 'sim':
+        return SimulatedBackend()
+    if name != 'auto':
+        raise ValueError(f'Unknown GPIO backend {name}')
+    if lgpio is not None:
+        try:
+            return LgpioBackend()
+        except Exception as e:
+            logging.warning(f'lgpio is not usable: {e}')
+    if GPIO is not None:
+        return RPiGPIOBackend()
+    logging.info('No GPIO library available. Using simulated GPIO.')
+    return SimulatedBackend()
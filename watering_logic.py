@@ -0,0 +1,239 @@
+import logging
+from datetime import datetime, timedelta
+
+# Decision code shared by the controller and the replay harness. Nothing in
+# here touches GPIO, I2C or the clock: the current time is always passed in.
+
+# Level sensor calibration: voltage -> liters
+LEVEL_SENSOR_FULL_VOLTAGE = 2.505  # Voltage reported when the tank holds TANK_CAPACITY_LITERS
+TANK_CAPACITY_LITERS = 1000        # Liters at LEVEL_SENSOR_FULL_VOLTAGE
+
+def is_valid_voltage(voltage, channel=None):
+    # Accept readings within the sensor's operating range
+    # (allow a small margin for noise around the empty/full ends).
+    # channel - calibrated watering_config.AdcChannel, None for the default sensor
+    if channel is None:
+        return voltage is not None and -0.05 <= voltage <= LEVEL_SENSOR_FULL_VOLTAGE + 0.1
+    return voltage is not None and channel.zero_voltage - 0.05 <= voltage <= channel.full_voltage + 0.1
+
+class LevelFilter:
+    '''Turns level sensor readings into a smoothed tank volume and flow.'''
+    VOLUME_HISTORY_SIZE = 3
+
+    def __init__(self):
+        self.water_volume = 0
+        self.water_flowtimer = 0
+        self.volume_history = []
+
+    def update(self, voltage_stat, now, channel=None):
+        '''
+        voltage_stat - valid voltage samples of one measurement
+        now - measurement time, seconds since the epoch
+        channel - calibrated watering_config.AdcChannel of the tank, None for
+        the default sensor
+        Returns (volume, flow), flow in l/min.
+        '''
+        if len(voltage_stat) == 0:
+            return (self.water_volume, 0)
+
+        voltage = sum(voltage_stat) / len(voltage_stat)
+        voltage = round(voltage, 4)
+        if channel is None:
+            # Convert voltage to liters: 0 V = empty, 2.505 V = 1000 liters
+            amount = (voltage / LEVEL_SENSOR_FULL_VOLTAGE) * TANK_CAPACITY_LITERS
+            capacity = TANK_CAPACITY_LITERS
+        else:
+            amount = channel.value(voltage)
+            capacity = channel.full_value
+        # Clamp to the physical range of the tank
+        amount = max(0, min(capacity, amount))
+        amount = round(amount, 0)
+        smoothed_amount, water_flow = self.smooth(amount, now)
+        logging.info(f'Voltage: {voltage} V, Volume: {smoothed_amount} liters, Water flow: {water_flow} l/min')
+        return (smoothed_amount, water_flow)
+
+    def update_distance(self, distance, geometry, now):
+        '''
+        distance - filtered ultrasonic distance in cm, None if no ping was valid
+        geometry - ((distance, liters), ...) table of the tank
+        Returns (volume, flow), flow in l/min.
+        '''
+        if distance is None:
+            return (self.water_volume, 0)
+        amount = round(distance_to_liters(geometry, distance), 0)
+        smoothed_amount, water_flow = self.smooth(amount, now)
+        logging.info(f'Distance: {distance} cm, Volume: {smoothed_amount} liters, Water flow: {water_flow} l/min')
+        return (smoothed_amount, water_flow)
+
+    def smooth(self, amount, now):
+        # Smooth volume using moving average to filter sensor noise
+        self.volume_history.append(amount)
+        if len(self.volume_history) > self.VOLUME_HISTORY_SIZE:
+            self.volume_history.pop(0)
+        smoothed_amount = round(sum(self.volume_history) / len(self.volume_history), 0)
+
+        old_flowtimer = self.water_flowtimer
+        now = round(now)
+        old_volume = self.water_volume
+        self.water_flowtimer = now
+        self.water_volume = smoothed_amount
+        water_flow = 0
+        if old_flowtimer > 0:
+            time_diff = now - old_flowtimer
+            if time_diff > 0:
+                water_diff = smoothed_amount - old_volume
+                water_flow = round((water_diff / time_diff) * 60)
+        return (smoothed_amount, water_flow)
+
+def filter_distances(samples, min_distance, max_distance, tolerance):
+    '''
+    Reduce raw ultrasonic pings (cm, None for a missed echo) to one distance.
+    Pings outside the sensor range are dropped, then everything further than
+    tolerance from the median is rejected as an outlier and the rest averaged.
+    '''
+    valid = sorted(d for d in samples if d is not None and min_distance <= d <= max_distance)
+    if not valid:
+        return None
+    middle = len(valid) // 2
+    median = valid[middle] if len(valid) % 2 else (valid[middle - 1] + valid[middle]) / 2
+    inliers = [d for d in valid if abs(d - median) <= tolerance]
+    return round(sum(inliers) / len(inliers), 1)
+
+def distance_to_liters(geometry, distance):
+    '''Interpolate the tank geometry table, clamped to its first and last rows.'''
+    if distance <= geometry[0][0]:
+        return geometry[0][1]
+    for (d1, l1), (d2, l2) in zip(geometry, geometry[1:]):
+        if distance <= d2:
+            return l1 + (l2 - l1) * (distance - d1) / (d2 - d1)
+    return geometry[-1][1]
+
+class RefillController:
+    '''Decides when the water input valve refills the tank.'''
+
+    def __init__(self):
+        self.refill_timer = 0
+
+    def step(self, general, now, water_amount, high_level, bobber_state):
+        '''
+        Returns the water input changes for this tick as a list of
+        (event, status) pairs in the order they have to be applied.
+        event is None when the refill state does not change.
+        '''
+        actions = []
+        if general.tank_refill_mode == 'bobber':
+            start_refill = bobber_state == 'low'
+            stop_refill = bobber_state == 'high'
+        elif general.tank_refill_mode == 'ultrasonic':
+            # The float switch still stops the refill if the sensor misreads
+            start_refill = water_amount < general.refill_amount and high_level == False
+            stop_refill = high_level == True or water_amount >= general.refill_full_amount
+        else:
+            # Level-sensor based refill (I2C KeySens via ADS1115)
+            start_refill = water_amount < general.refill_amount and high_level == False
+            stop_refill = high_level == True
+        if start_refill:
+            logging.info('Start refill')
+            actions.append(('refill_start' if self.refill_timer == 0 else None, True))
+            self.refill_timer = now
+        if self.refill_timer > 0 and now - self.refill_timer > general.refill_timeout*60:
+            logging.info('Force stop refill')
+            self.refill_timer = 0
+            actions.append(('refill_timeout', False))
+        if stop_refill:
+            logging.info('Stop refill')
+            actions.append(('refill_stop' if self.refill_timer > 0 else None, False))
+            self.refill_timer = 0
+        return actions
+
+class TransitionPlanner:
+    '''
+    Make-before-break relay sequencing. Valves that open in a tick open
+    before the ones that close, so a zone handing over to the next one
+    keeps the pump running instead of cycling main power off and on.
+    '''
+
+    def __init__(self):
+        self.avoided_pump_cycles = 0
+
+    def plan(self, current, targets):
+        '''
+        current - {channel: True = ON} of every output except main power
+        targets - {channel: True = ON} of the outputs decided in this tick
+        Returns the changes ({channel: True = ON}) to apply in order, waiting
+        the valve overlap time between them: new valves open, then old ones
+        close. Outputs that do not change are left out, so a manual command
+        arriving during the overlap is not undone by the second step.
+        '''
+        opening = [ch for ch, status in targets.items() if status and not current[ch]]
+        closing = [ch for ch, status in targets.items() if not status and current[ch]]
+        steps = []
+        if opening:
+            steps.append(dict.fromkeys(opening, True))
+        if closing:
+            steps.append(dict.fromkeys(closing, False))
+        if opening and closing and not any(status for ch, status in current.items() if ch not in closing):
+            # Closing first would have left no valve open and cycled the pump
+            self.avoided_pump_cycles += 1
+            logging.info(f'Make-before-break transition, {self.avoided_pump_cycles} pump cycles avoided')
+        return steps
+
+def zone_targets(config, blocked_zones, rain_status, now):
+    '''
+    Returns {zone name: needs watering} for every zone that is not blocked by
+    a manual command. Expired blocks are removed from blocked_zones.
+    now - seconds since the epoch
+    '''
+    targets = {}
+    now_dt = datetime.fromtimestamp(now)
+    for zone in config.zones:
+        zone_name = zone.name
+        logging.info(zone_name)
+        if zone_name in blocked_zones:
+            if now - blocked_zones[zone_name] > config.general.blocking_timeout*60:
+                logging.info(f'Force unblock zone {zone_name}')
+                blocked_zones.pop(zone_name)
+            else:
+                logging.info(f'{zone_name} zone is blocked')
+                continue
+        current_needs = False
+        if rain_status == False and zone.needs_watering(now_dt):
+            logging.info(f'{zone_name} zone needs watering')
+            current_needs = True
+        targets[zone_name] = current_needs
+    return targets
+
+def next_transition(zone, now):
+    '''
+    The next time the schedule of zone switches it, as (timestamp, True = ON),
+    None for zones without a schedule or whose schedule never switches them
+    off. Periods that overlap or touch count as one, like in
+    zone.needs_watering(); rain and manual blocks are ignored.
+    now - seconds since the epoch
+    '''
+    if not zone.schedule:
+        return None
+    today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    window_end = (today + timedelta(days=8)).timestamp()
+    intervals = []
+    for offset in range(8):
+        day = today + timedelta(days=offset)
+        midnight = day.timestamp()
+        for period in zone.schedule:
+            if period.weekday == day.weekday():
+                # Periods never run past midnight
+                intervals.append((midnight + period.start, midnight + min(period.end, 86400)))
+    intervals.sort()
+    start, end = intervals[0]
+    for next_start, next_end in intervals[1:] + [(float('inf'), float('inf'))]:
+        if next_start <= end:
+            end = max(end, next_end)
+            continue
+        if start <= now <= end:
+            # Still ON at the end of the window: the weekly schedule covers
+            # the whole week and the zone never switches off
+            return (end, False) if end < window_end else None
+        if now < start:
+            return (start, True)
+        start, end = next_start, next_end
+    return None
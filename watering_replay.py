@@ -0,0 +1,218 @@
+#! /usr/bin/python3
+
+# Deterministic replay of recorded sensor data through the controller's
+# decision code (watering_logic) on a virtual clock.
+#
+# Usage:
+#   watering_replay.py CONFIG TRACE [--golden FILE [--update-golden]] [--save-trace FILE]
+#
+# Regression check, exits 1 with a diff when the decisions changed:
+#   watering_replay.py replay/sample.yaml replay/sample.log --golden replay/sample.golden
+#
+# TRACE is either a watering_control.log (rotated logs can be concatenated)
+# or a compact trace: one JSON object per line, e.g.
+#   {"t": "2026-07-04 21:00:12", "voltage": [1.71, 1.70], "low": false, "high": false, "bobber": "middle", "rain": false}
+#   {"t": "2026-07-04 21:00:42", "distance": [61.2, null, 60.9, 140.0, 61.0]}
+#   {"t": "2026-07-04 21:03:40", "command": ["bottom_grass", "OFF"]}
+# A line without "command" is one main loop tick; sensor fields it leaves
+# out keep their previous value. A log tick without a Voltage or Distance
+# line had no valid reading and is replayed with none, like the controller
+# falling back to its cached values.
+
+import re
+import sys
+import json
+import time
+import difflib
+import logging
+import argparse
+from datetime import datetime
+import watering_config
+import watering_logic
+
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+) - \w+ - (.*)$')
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S,%f'
+TRACE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def parse_time(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+def read_trace(path):
+    '''Yield tick and command records from a compact trace file.'''
+    with open(path) as stream:
+        for line in stream:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                record['t'] = parse_time(record['t'])
+                yield record
+
+def read_log(path):
+    '''Yield tick and command records reconstructed from watering_control.log.'''
+    tick = None
+    with open(path, errors='replace') as stream:
+        for line in stream:
+            match = LOG_LINE.match(line.rstrip('\n'))
+            if not match:
+                continue
+            t = datetime.strptime(match.group(1), LOG_TIME_FORMAT).timestamp()
+            message = match.group(2)
+            if message == 'Main loop started':
+                tick = {'t': t, 'rain': False, 'voltage': [], 'distance': []}
+            elif message == 'Main loop done':
+                if tick is not None:
+                    yield tick
+                tick = None
+            elif message.startswith('Set ') and ' zone (' in message:
+                # on_message: "Set <zone> zone (<channel>) to <command>"
+                zone, command = re.match(r'Set (\S+) zone \(\d+\) to (\S+)', message).groups()
+                yield {'t': t, 'command': [zone, command]}
+            elif tick is None:
+                continue
+            elif message == 'Rain detected. No need watering.':
+                tick['rain'] = True
+            elif message.startswith('Voltage: '):
+                tick['voltage'] = [float(message.split()[1])]
+            elif message.startswith('Distance: '):
+                tick['distance'] = [float(message.split()[1])]
+            elif message.startswith('Low: '):
+                low, high = re.match(r'Low: (\w+), High: (\w+)', message).groups()
+                tick['low'] = low == 'True'
+                tick['high'] = high == 'True'
+            elif message.startswith('Bobber: '):
+                tick['bobber'] = message.split()[1]
+
+def save_trace(records, path):
+    with open(path, 'w') as stream:
+        for record in records:
+            record = dict(record, t=datetime.fromtimestamp(record['t']).isoformat(sep=' ', timespec='seconds'))
+            stream.write(json.dumps(record) + '\n')
+
+class ReplayOutputs:
+    '''Relay outputs with the same switching rules as RPIWatering.apply().'''
+
+    def __init__(self, config):
+        self.names = {config.general.main_power_channel: 'main_power'}
+        if config.general.water_input_channel is not None:
+            self.names[config.general.water_input_channel] = 'water_input'
+        for zone in config.zones:
+            self.names[zone.channel] = zone.name
+        self.main_power_pin = config.general.main_power_channel
+        self.states = {ch: False for ch in config.chan_list}
+        self.timeline = []
+
+    def switch(self, channel, status, now):
+        self.states[channel] = status
+        stamp = datetime.fromtimestamp(now).strftime(TRACE_TIME_FORMAT)
+        self.timeline.append(f"{stamp} {self.names[channel]} {'ON' if status else 'OFF'}")
+
+    def get_states(self):
+        return {ch: status for ch, status in self.states.items() if ch != self.main_power_pin}
+
+    def set_status(self, channel, status, now):
+        if self.states[channel] != status:
+            self.apply({channel: status}, now)
+
+    def apply(self, changes, now):
+        states = self.get_states()
+        states.update((ch, status) for ch, status in changes.items() if ch != self.main_power_pin)
+        target_status = any(states.values())
+        switch_main_power = self.states[self.main_power_pin] != target_status
+        if switch_main_power and target_status == False:
+            self.switch(self.main_power_pin, False, now)
+        for ch, status in changes.items():
+            if ch != self.main_power_pin and self.states[ch] != status:
+                self.switch(ch, status, now)
+        if switch_main_power and target_status == True:
+            self.switch(self.main_power_pin, True, now)
+
+def replay(config, records):
+    '''Run records through the decision code, return the actuation timeline and avoided pump cycles.'''
+    general = config.general
+    outputs = ReplayOutputs(config)
+    level_filter = watering_logic.LevelFilter()
+    tank_channel = None
+    if config.adc is not None:
+        tank_channel = next((channel for channel in config.adc.channels if channel.name == 'tank'), None)
+    refill = watering_logic.RefillController()
+    planner = watering_logic.TransitionPlanner()
+    blocked_zones = {}
+    sensors = {'voltage': [], 'distance': [], 'high': False, 'bobber': 'middle', 'rain': False}
+    for record in records:
+        now = record['t']
+        if 'command' in record:
+            zone, command = record['command']
+            if zone not in config.zones_by_name:
+                continue
+            channel = config.zones_by_name[zone].channel
+            if command == 'ON':
+                outputs.set_status(channel, True, now)
+                blocked_zones[zone] = now
+            if command == 'OFF':
+                outputs.set_status(channel, False, now)
+                blocked_zones.pop(zone, None)
+            continue
+        sensors.update((key, value) for key, value in record.items() if key in sensors)
+        targets = {}
+        if general.water_input_channel is not None:
+            if config.ultrasonic is not None:
+                ultrasonic = config.ultrasonic
+                distance = watering_logic.filter_distances(sensors['distance'], ultrasonic.min_distance,
+                                                           ultrasonic.max_distance, ultrasonic.tolerance)
+                water_amount, water_flow = level_filter.update_distance(distance, ultrasonic.geometry, now)
+            else:
+                voltage_stat = [v for v in sensors['voltage'] if watering_logic.is_valid_voltage(v, tank_channel)]
+                water_amount, water_flow = level_filter.update(voltage_stat, now, tank_channel)
+            for event, status in refill.step(general, now, water_amount, sensors['high'], sensors['bobber']):
+                targets[general.water_input_channel] = status
+        for zone_name, status in watering_logic.zone_targets(config, blocked_zones, sensors['rain'], now).items():
+            targets[config.zones_by_name[zone_name].channel] = status
+        for i, changes in enumerate(planner.plan(outputs.get_states(), targets)):
+            outputs.apply(changes, now + i*general.valve_overlap)
+    return outputs.timeline, planner.avoided_pump_cycles
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded sensor data through the watering decision code.')
+    parser.add_argument('config', help='watering config YAML')
+    parser.add_argument('trace', help='watering_control.log or a .jsonl trace')
+    parser.add_argument('--golden', help='expected actuation timeline')
+    parser.add_argument('--update-golden', action='store_true', help='write the timeline to --golden')
+    parser.add_argument('--save-trace', help='convert the input to a compact .jsonl trace')
+    args = parser.parse_args()
+
+    # The decision code logs every tick, keep the replay quiet
+    logging.disable(logging.INFO)
+    config = watering_config.load(args.config)
+    if args.trace.endswith('.jsonl'):
+        records = list(read_trace(args.trace))
+    else:
+        records = list(read_log(args.trace))
+    if args.save_trace:
+        save_trace(records, args.save_trace)
+
+    started = time.perf_counter()
+    timeline, avoided_pump_cycles = replay(config, records)
+    elapsed = time.perf_counter() - started
+    print(f'Replayed {len(records)} records in {elapsed:.3f}s, {len(timeline)} actuations, '
+          f'{avoided_pump_cycles} pump cycles avoided', file=sys.stderr)
+
+    if args.golden is None:
+        print('\n'.join(timeline))
+        return 0
+    if args.update_golden:
+        with open(args.golden, 'w') as stream:
+            stream.write('\n'.join(timeline) + '\n')
+        return 0
+    with open(args.golden) as stream:
+        expected = stream.read().splitlines()
+    diff = list(difflib.unified_diff(expected, timeline, args.golden, 'replay', lineterm=''))
+    if diff:
+        print('\n'.join(diff))
+        return 1
+    print('Timeline matches the golden file', file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
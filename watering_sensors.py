@@ -0,0 +1,227 @@
+import time
+import logging
+import threading
+from collections import deque
+try:
+    from smbus2 import SMBus
+except ImportError:
+    SMBus = None
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+import watering_logic
+
+# ADS1115 registers
+ADS1115_REG_CONVERSION = 0x00
+ADS1115_REG_CONFIG = 0x01
+ADS1115_REG_LO_THRESH = 0x02
+ADS1115_REG_HI_THRESH = 0x03
+
+# Config register fields
+ADS1115_OS_SINGLE = 0x8000        # Start a single conversion / conversion done
+ADS1115_MUX_SINGLE = 0x4000       # AINx against GND, input number in bits 12-13
+ADS1115_MODE_SINGLE = 0x0100
+ADS1115_COMP_QUE_1 = 0x0000       # ALERT/RDY asserts after every conversion
+ADS1115_GAIN = {2/3: 0x0000, 1: 0x0200, 2: 0x0400, 4: 0x0600, 8: 0x0800, 16: 0x0A00}
+ADS1115_FULL_SCALE = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+ADS1115_DATA_RATE = {8: 0x0000, 16: 0x0020, 32: 0x0040, 64: 0x0060,
+                     128: 0x0080, 250: 0x00A0, 475: 0x00C0, 860: 0x00E0}
+
+class ADS1115Scanner:
+    '''
+    Cycles through the configured ADS1115 channels in a background thread
+    using plain smbus2 register transfers. Each conversion is single-shot;
+    with an ALERT/RDY pin the thread sleeps until the conversion-ready
+    interrupt instead of polling. Every channel keeps a ring buffer of its
+    latest voltages.
+    '''
+
+    def __init__(self, adc, gpio):
+        self.adc = adc
+        self.gpio = gpio
+        self.channels = {channel.name: channel for channel in adc.channels}
+        self.samples = {channel.name: deque(maxlen=channel.buffer_size) for channel in adc.channels}
+        self.config_words = {channel.name: self.config_word(channel) for channel in adc.channels}
+        self.ready = threading.Event()
+        self.bus = None
+        self.running = False
+
+    @staticmethod
+    def config_word(channel):
+        return (ADS1115_OS_SINGLE
+                | ADS1115_MUX_SINGLE | (channel.input << 12)
+                | ADS1115_GAIN[channel.gain]
+                | ADS1115_MODE_SINGLE
+                | ADS1115_DATA_RATE[channel.data_rate]
+                | ADS1115_COMP_QUE_1)
+
+    def write_register(self, register, value):
+        self.bus.write_i2c_block_data(self.adc.address, register, [value >> 8, value & 0xFF])
+
+    def read_register(self, register):
+        high, low = self.bus.read_i2c_block_data(self.adc.address, register, 2)
+        return (high << 8) | low
+
+    def start(self, background=True):
+        '''Open the bus. Without background the caller runs scan() itself.'''
+        self.bus = SMBus(self.adc.bus)
+        if self.adc.alert_pin is not None:
+            # Hi_thresh MSB set and Lo_thresh MSB clear turn ALERT/RDY into
+            # a conversion-ready output (active low).
+            self.write_register(ADS1115_REG_HI_THRESH, 0x8000)
+            self.write_register(ADS1115_REG_LO_THRESH, 0x0000)
+            self.gpio.add_falling_edge_callback(self.adc.alert_pin, self.ready.set)
+        self.running = True
+        if background:
+            threading.Thread(target=self.run, daemon=True).start()
+        logging.info(f'ADS1115 scanner started for {", ".join(self.channels)}')
+
+    def stop(self):
+        self.running = False
+
+    def read_voltage(self, name):
+        '''Run one conversion on a channel and return its voltage.'''
+        channel = self.channels[name]
+        conversion_time = 1 / channel.data_rate
+        self.ready.clear()
+        self.write_register(ADS1115_REG_CONFIG, self.config_words[name])
+        if self.adc.alert_pin is None or not self.ready.wait(conversion_time * 2 + 0.01):
+            time.sleep(conversion_time * 1.1)
+            # OS bit reads 1 once the conversion is done
+            for attempt in range(10):
+                if self.read_register(ADS1115_REG_CONFIG) & ADS1115_OS_SINGLE:
+                    break
+                time.sleep(conversion_time * 0.1)
+            else:
+                raise TimeoutError('conversion did not complete')
+        raw = self.read_register(ADS1115_REG_CONVERSION)
+        if raw & 0x8000:
+            raw -= 1 << 16
+        return raw * ADS1115_FULL_SCALE[channel.gain] / 32768
+
+    def scan(self):
+        '''Convert every channel once.'''
+        for name in self.channels:
+            try:
+                self.samples[name].append(self.read_voltage(name))
+            except Exception as e:
+                logging.error(f'Failed to read ADS1115 channel {name}: {e}')
+
+    def run(self):
+        while self.running:
+            self.scan()
+            time.sleep(self.adc.scan_interval)
+
+    def voltages(self, name):
+        '''Latest voltages of a channel, oldest first.'''
+        return list(self.samples[name])
+
+    def value(self, name):
+        '''Calibrated average of the buffered samples, None before the first one.'''
+        voltages = self.voltages(name)
+        if not voltages:
+            return None
+        return self.channels[name].value(sum(voltages) / len(voltages))
+
+# Echo pulse length (us) -> distance (cm): half the round trip at 343 m/s
+ULTRASONIC_CM_PER_US = 0.01715
+
+class UltrasonicSensor:
+    '''
+    AJ-SR04M ultrasonic ranging with hardware timestamped echo edges.
+
+    The echo pin is watched with pigpio callbacks (DMA sampled ticks) when the
+    pigpio daemon is running, otherwise with lgpio alerts (kernel timestamps).
+    Between pings the caller just waits on an event, no CPU is spent polling.
+    '''
+
+    def __init__(self, ultrasonic):
+        self.ultrasonic = ultrasonic
+        self.echo = threading.Event()
+        self.rise = None
+        self.pulse_us = None
+        self.pi = None
+        self.chip = None
+        self.callback = None
+
+    def start(self):
+        trigger, echo = self.ultrasonic.trigger_pin, self.ultrasonic.echo_pin
+        if pigpio is not None:
+            pi = pigpio.pi()
+            if pi.connected:
+                self.pi = pi
+                pi.set_mode(trigger, pigpio.OUTPUT)
+                pi.write(trigger, 0)
+                pi.set_mode(echo, pigpio.INPUT)
+                self.callback = pi.callback(echo, pigpio.EITHER_EDGE, self.pigpio_edge)
+                logging.info('Ultrasonic sensor uses pigpio edge capture.')
+                return
+            logging.warning('pigpio daemon is not running, falling back to lgpio.')
+        if lgpio is None:
+            raise RuntimeError('neither pigpio nor lgpio is available')
+        self.chip = lgpio.gpiochip_open(0)
+        lgpio.gpio_claim_output(self.chip, trigger, 0)
+        lgpio.gpio_claim_alert(self.chip, echo, lgpio.BOTH_EDGES)
+        self.callback = lgpio.callback(self.chip, echo, lgpio.BOTH_EDGES, self.lgpio_edge)
+        logging.info('Ultrasonic sensor uses lgpio edge capture.')
+
+    def pigpio_edge(self, gpio, level, tick):
+        # tick is in microseconds and wraps every 72 minutes
+        if level == 1:
+            self.rise = tick
+        elif level == 0 and self.rise is not None:
+            self.pulse_us = pigpio.tickDiff(self.rise, tick)
+            self.echo.set()
+
+    def lgpio_edge(self, chip, gpio, level, timestamp):
+        # timestamp is in nanoseconds
+        if level == 1:
+            self.rise = timestamp
+        elif level == 0 and self.rise is not None:
+            self.pulse_us = (timestamp - self.rise) / 1000
+            self.echo.set()
+
+    def trigger(self):
+        if self.pi is not None:
+            self.pi.gpio_trigger(self.ultrasonic.trigger_pin, 10, 1)
+        else:
+            lgpio.gpio_write(self.chip, self.ultrasonic.trigger_pin, 1)
+            time.sleep(0.00001)
+            lgpio.gpio_write(self.chip, self.ultrasonic.trigger_pin, 0)
+
+    def ping(self):
+        '''One distance in cm, None if no echo came back in time.'''
+        self.echo.clear()
+        self.rise = None
+        self.trigger()
+        if not self.echo.wait(self.ultrasonic.timeout):
+            return None
+        return round(self.pulse_us * ULTRASONIC_CM_PER_US, 1)
+
+    def pings(self):
+        samples = []
+        for i in range(self.ultrasonic.samples):
+            if i:
+                time.sleep(self.ultrasonic.ping_interval)
+            samples.append(self.ping())
+        return samples
+
+    def measure(self):
+        '''Median filtered distance in cm, None if every ping was rejected.'''
+        return watering_logic.filter_distances(self.pings(),
+                                               self.ultrasonic.min_distance,
+                                               self.ultrasonic.max_distance,
+                                               self.ultrasonic.tolerance)
+
+    def cleanup(self):
+        if self.callback is not None:
+            self.callback.cancel()
+        if self.pi is not None:
+            self.pi.stop()
+        if self.chip is not None:
+            lgpio.gpiochip_close(self.chip)
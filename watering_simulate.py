@@ -0,0 +1,278 @@
+#! /usr/bin/python3
+
+# What-if water demand of a watering config over a whole season, at minute
+# resolution. Every minute is one controller tick: a zone is ON in the
+# minutes from its period start up to, but not including, the period end, so
+# an entry waters for exactly its duration and back-to-back entries do not
+# overlap. Periods do not wrap past midnight and no zone waters on a rain day.
+#
+# Usage:
+#   watering_simulate.py CONFIG [--start 2026-06-01] [--days 92]
+#       [--flow ZONE=L_PER_MIN ...] [--default-flow 10] [--refill-rate 20]
+#       [--rain RAIN_CALENDAR] [--initial LITERS]
+#
+# RAIN_CALENDAR lists one rain day (YYYY-MM-DD) per line, # starts a comment.
+# Local time without DST shifts.
+
+import sys
+import time
+import argparse
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+import numpy as np
+import watering_config
+from watering_logic import TANK_CAPACITY_LITERS
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+BOBBER_LOW_LITERS = 600  # the low bobber switch sits at about 600 liters
+REFILL_WINDOW = MINUTES_PER_DAY
+
+@dataclass(slots=True)
+class SimulationResult:
+    start: datetime
+    zones: tuple
+    weekly_liters: list             # [(week start, {zone: liters}), ...]
+    peak_flow: float                # l/min drawn by all zones together
+    peak_flow_at: datetime
+    peak_zones: int                 # most zones ON in the same minute
+    refills: int
+    refill_timeouts: int
+    deficit_hours: float            # hours with demand the empty tank could not serve
+    unmet_liters: float
+    dry_times: list                 # when the tank ran dry
+    overlaps: list                  # [(zone, period, zone, period), ...] watering at the same time
+    volume: np.ndarray = field(repr=False, default=None)  # liters at the start of every minute, None without a tank
+
+def read_rain_calendar(path):
+    days = set()
+    with open(path) as stream:
+        for line in stream:
+            line = line.split('#')[0].strip()
+            if line:
+                days.add(date.fromisoformat(line))
+    return days
+
+def period_minutes(period):
+    '''First and last minute of the day the period is active in, the end minute is not.'''
+    first = -(-period.start // 60)
+    last = min(-(-period.end // 60) - 1, MINUTES_PER_DAY - 1)
+    return first, last
+
+def schedule_masks(zones, start, days, rain_days=()):
+    '''zones x minutes array, True where a zone waters.'''
+    week = np.zeros((len(zones), MINUTES_PER_WEEK), dtype=bool)
+    for i, zone in enumerate(zones):
+        for period in zone.schedule:
+            first, last = period_minutes(period)
+            offset = period.weekday * MINUTES_PER_DAY
+            week[i, offset + first:offset + last + 1] = True
+    minutes = np.arange(days * MINUTES_PER_DAY)
+    masks = week[:, (start.weekday() * MINUTES_PER_DAY + minutes) % MINUTES_PER_WEEK]
+    rain = np.array([(start + timedelta(days=day)).date() in rain_days for day in range(days)])
+    if rain.any():
+        masks &= ~np.repeat(rain, MINUTES_PER_DAY)
+    return masks
+
+def schedule_overlaps(zones):
+    '''Schedule entries of different zones that water in the same minute.'''
+    entries = [(zone, period) for zone in zones for period in zone.schedule]
+    overlaps = []
+    for i, (zone, period) in enumerate(entries):
+        first, last = period_minutes(period)
+        for other_zone, other in entries[i + 1:]:
+            if other_zone is zone or other.weekday != period.weekday:
+                continue
+            other_first, other_last = period_minutes(other)
+            if first <= other_last and other_first <= last:
+                overlaps.append((zone.name, period, other_zone.name, other))
+    return overlaps
+
+def reflect(levels):
+    '''
+    Tank levels that cannot go below zero: the running minimum of the
+    unbounded levels is the water that was missing. Returns (levels, missing).
+    '''
+    missing = -np.minimum(np.minimum.accumulate(levels), 0)
+    return levels + missing, missing
+
+def simulate_tank(demand, refill_rate, initial, start_level, full_level, timeout):
+    '''
+    Tank volume under demand (l/min per minute), refilled at refill_rate like
+    RefillController: refill starts below start_level, stops at full_level or
+    timeout minutes after the level was last below start_level.
+    Returns (volume, unmet, refill start minutes, refill timeout minutes).
+    '''
+    n = len(demand)
+    volume = np.empty(n)
+    unmet = np.zeros(n)
+    refills = []
+    timeouts = []
+    t = 0
+    level = float(initial)
+    refilling = False
+    timer = 0
+    window = REFILL_WINDOW
+    while t < n:
+        end = min(n, t + window)
+        net = -demand[t:end] + (refill_rate if refilling else 0)
+        # levels[k] is the volume at the start of minute t + k
+        levels, missing = reflect(np.concatenate(([level], level + np.cumsum(net))))
+        ticks = np.arange(t, end + 1)
+        if not refilling:
+            below = np.flatnonzero(levels[:-1] < start_level)
+            event = below[0] if len(below) else None
+        else:
+            # The refill timer restarts every tick the level is below start_level
+            last_below = np.maximum.accumulate(np.where(levels < start_level, ticks, timer))
+            timed_out = ticks - last_below > timeout
+            # The tick that started the refill has already been decided
+            first = 1 if t == refills[-1] else 0
+            stopped = np.flatnonzero((timed_out | (levels >= full_level))[first:-1])
+            event = stopped[0] + first if len(stopped) else None
+        if event is None:
+            # No refill decision in this window, continue with a longer one
+            volume[t:end] = levels[:-1]
+            unmet[t:end] = np.diff(missing)
+            if refilling:
+                timer = last_below[-2]
+            level = levels[-1]
+            t = end
+            window *= 2
+            continue
+        volume[t:t + event] = levels[:event]
+        unmet[t:t + event] = np.diff(missing[:event + 1])
+        t += event
+        level = levels[event]
+        if refilling:
+            if timed_out[event]:
+                timeouts.append(t)
+            level = min(level, full_level)
+            refilling = False
+        else:
+            refills.append(t)
+            refilling = True
+            timer = t
+        window = REFILL_WINDOW
+    return volume, unmet, refills, timeouts
+
+def refill_levels(general, capacity):
+    '''(start below, stop at) liters of the configured refill mode.'''
+    if general.tank_refill_mode == 'bobber':
+        return BOBBER_LOW_LITERS, capacity
+    if general.tank_refill_mode == 'ultrasonic':
+        return general.refill_amount, general.refill_full_amount
+    return general.refill_amount, capacity
+
+def simulate(config, flows, refill_rate, start, days, rain_days=(), initial=None, default_flow=10):
+    '''
+    config - watering_config.Config
+    flows - {zone name: l/min}, zones not listed use default_flow
+    refill_rate - l/min the water input adds to the tank
+    start - first day of the season (datetime), days - season length
+    rain_days - dates without watering
+    '''
+    if not isinstance(start, datetime):
+        start = datetime.combine(start, datetime.min.time())
+    zones = config.zones
+    capacity = TANK_CAPACITY_LITERS
+    if config.ultrasonic is not None:
+        capacity = max(row[1] for row in config.ultrasonic.geometry)
+    start_level, full_level = refill_levels(config.general, capacity)
+    masks = schedule_masks(zones, start, days, rain_days)
+    rates = np.array([flows.get(zone.name, default_flow) for zone in zones], dtype=float)
+    demand = rates @ masks
+
+    if config.general.water_input_channel is None:
+        # Without a water input the zones are not fed from a tank
+        volume, unmet, refills, timeouts = None, np.zeros(len(demand)), [], []
+    else:
+        volume, unmet, refills, timeouts = simulate_tank(
+            demand, refill_rate, capacity if initial is None else initial,
+            start_level, full_level, config.general.refill_timeout)
+
+    per_minute = masks * rates[:, None]
+    week_starts = np.arange(0, days * MINUTES_PER_DAY, MINUTES_PER_WEEK)
+    weekly = np.add.reduceat(per_minute, week_starts, axis=1) if len(zones) else np.zeros((0, len(week_starts)))
+    weekly_liters = [(start + timedelta(minutes=int(minute)),
+                      {zone.name: float(weekly[i, week]) for i, zone in enumerate(zones)})
+                     for week, minute in enumerate(week_starts)]
+
+    dry = unmet > 0
+    dry_starts = np.flatnonzero(dry & ~np.concatenate(([False], dry[:-1])))
+    peak = int(np.argmax(demand)) if len(demand) else 0
+    return SimulationResult(
+        start=start,
+        zones=tuple(zone.name for zone in zones),
+        weekly_liters=weekly_liters,
+        peak_flow=float(demand[peak]) if len(demand) else 0,
+        peak_flow_at=start + timedelta(minutes=peak),
+        peak_zones=int(masks.sum(axis=0).max()) if masks.size else 0,
+        refills=len(refills),
+        refill_timeouts=len(timeouts),
+        deficit_hours=dry.sum() / 60,
+        unmet_liters=float(unmet.sum()),
+        dry_times=[start + timedelta(minutes=int(minute)) for minute in dry_starts],
+        overlaps=schedule_overlaps(zones),
+        volume=volume,
+    )
+
+def format_report(result):
+    widths = [max(8, len(name)) for name in result.zones]
+    lines = ['Week       ' + ''.join(f' {name:>{width}}' for name, width in zip(result.zones, widths)) + '    Total']
+    for week_start, liters in result.weekly_liters:
+        lines.append(f'{week_start:%Y-%m-%d} '
+                     + ''.join(f' {liters[name]:{width}.0f}' for name, width in zip(result.zones, widths))
+                     + f' {sum(liters.values()):8.0f}')
+    lines.append(f'Peak flow: {result.peak_flow:.1f} l/min at {result.peak_flow_at:%Y-%m-%d %H:%M}, '
+                 f'up to {result.peak_zones} zones at once')
+    if result.volume is None:
+        lines.append('No water input configured, the zones are not fed from the tank')
+    else:
+        lines.append(f'Refills: {result.refills}, {result.refill_timeouts} stopped by refill_timeout')
+        lines.append(f'Tank deficit: {result.deficit_hours:.1f} hours, {result.unmet_liters:.0f} liters not delivered')
+        for dry_time in result.dry_times:
+            lines.append(f'  tank dry at {dry_time:%Y-%m-%d %H:%M}')
+    lines.append(f'Overlapping schedule entries: {len(result.overlaps)}')
+    for zone, period, other_zone, other in result.overlaps:
+        lines.append(f'  {period.day} {zone} {period.time} ({period.duration} min) and '
+                     f'{other_zone} {other.time} ({other.duration} min)')
+    return '\n'.join(lines)
+
+def parse_flow(value):
+    name, _, rate = value.partition('=')
+    try:
+        return name, float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected ZONE=L_PER_MIN, got {value!r}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the water demand of a watering config over a season.')
+    parser.add_argument('config', help='watering config YAML')
+    parser.add_argument('--start', type=date.fromisoformat, default=date(date.today().year, 6, 1),
+                        help='first day of the season, YYYY-MM-DD (default June 1)')
+    parser.add_argument('--days', type=int, default=92, help='season length in days')
+    parser.add_argument('--flow', type=parse_flow, action='append', default=[], metavar='ZONE=L_PER_MIN',
+                        help='flow of a zone, may be repeated')
+    parser.add_argument('--default-flow', type=float, default=10, help='l/min of zones without --flow')
+    parser.add_argument('--refill-rate', type=float, default=20, help='l/min added by the water input')
+    parser.add_argument('--rain', help='rain calendar, one YYYY-MM-DD per line')
+    parser.add_argument('--initial', type=float, help='tank liters at the start (default full)')
+    args = parser.parse_args()
+
+    config = watering_config.load(args.config)
+    unknown = [name for name, rate in args.flow if name not in config.zones_by_name]
+    if unknown:
+        parser.error(f'unknown zones: {", ".join(unknown)}')
+    rain_days = read_rain_calendar(args.rain) if args.rain else set()
+
+    started = time.perf_counter()
+    result = simulate(config, dict(args.flow), args.refill_rate, args.start, args.days,
+                      rain_days=rain_days, initial=args.initial, default_flow=args.default_flow)
+    elapsed = time.perf_counter() - started
+    print(format_report(result))
+    print(f'Simulated {args.days} days in {elapsed:.3f}s', file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
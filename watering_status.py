@@ -0,0 +1,115 @@
+import os
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit, parse_qs
+
+# Read-only local status API. The controller pushes a snapshot of its state
+# after every change; requests are answered from that snapshot and never
+# touch GPIO or I2C.
+#
+#   GET /status             current snapshot, with an ETag
+#   If-None-Match: <etag>   304 while the snapshot did not change
+#   GET /status?wait=30     with If-None-Match, hold the request until the
+#                           snapshot changes or the wait runs out (long poll)
+
+MAX_WAIT = 300  # seconds a long poll may be held
+
+class StatusSnapshot:
+    '''Latest controller state as versioned JSON. The version only moves when the state changes.'''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Versions restart at 0 with every process, the boot id keeps the
+        # ETags of a previous run from matching
+        self.boot_id = os.urandom(4).hex()
+        self.version = 0
+        self.data = None
+        self.body = json.dumps({'version': 0}).encode()
+
+    def update(self, data):
+        with self.condition:
+            if data == self.data:
+                return
+            self.data = data
+            self.version += 1
+            self.body = json.dumps({'version': self.version, **data}).encode()
+            self.condition.notify_all()
+
+    def etag(self, version):
+        return f'"{self.boot_id}-{version}"'
+
+    def get(self):
+        with self.condition:
+            return self.version, self.body
+
+    def wait(self, version, timeout):
+        '''Wait up to timeout seconds for a version other than version.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version, self.body
+
+class StatusHandler(BaseHTTPRequestHandler):
+    server_version = 'watering_control'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in ('/', '/status'):
+            self.send_error(404)
+            return
+        try:
+            wait = min(float(parse_qs(url.query).get('wait', ['0'])[0]), MAX_WAIT)
+        except ValueError:
+            self.send_error(400, 'wait must be a number of seconds')
+            return
+        known = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        snapshot = self.server.snapshot
+        version, body = snapshot.get()
+        if wait > 0 and snapshot.etag(version) in known:
+            version, body = snapshot.wait(version, wait)
+        if snapshot.etag(version) in known or '*' in known:
+            self.send_response(304)
+            self.send_header('ETag', snapshot.etag(version))
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', snapshot.etag(version))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug(f'Status API {self.address_string()}: {format % args}')
+
+class StatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class UnixStatusServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # A socket left behind by a previous run
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+def start(snapshot, port=None, socket_path=None):
+    '''Serve snapshot on a Unix socket or a localhost port from a background thread.'''
+    if socket_path is not None:
+        server = UnixStatusServer(socket_path, StatusHandler)
+        where = socket_path
+    else:
+        server = StatusServer(('127.0.0.1', port), StatusHandler)
+        where = f'127.0.0.1:{port}'
+    server.snapshot = snapshot
+    threading.Thread(target=server.serve_forever, name='status_api', daemon=True).start()
+    logging.info(f'Status API listening on {where}')
+    return server